@@ -65,6 +65,10 @@ namespace DmxServer
                     {
                         result = ExecutePut(dmx, request);
                     }
+                    else if (request.Url.AbsolutePath == "/dmx/spans")
+                    {
+                        result = ExecutePutSpans(dmx, request);
+                    }
                     else
                     {
                         result = new Result { Code = HttpStatusCode.NotFound, Content = "Path " + request.Url.AbsolutePath + " not found" };
@@ -157,24 +161,47 @@ namespace DmxServer
             return result;
         }
 
+        static bool IsBinary(HttpListenerRequest request)
+        {
+            return request.ContentType != null && request.ContentType.StartsWith("application/octet-stream");
+        }
+
+        static byte[] ReadBody(HttpListenerRequest request)
+        {
+            var buffer = new byte[request.ContentLength64];
+            int offset = 0;
+            while (offset < buffer.Length)
+            {
+                int n = request.InputStream.Read(buffer, offset, buffer.Length - offset);
+                if (n <= 0)
+                {
+                    throw new ArgumentException("Request body ended after " + offset + " of " + buffer.Length + " bytes");
+                }
+                offset += n;
+            }
+            return buffer;
+        }
+
         static Result ExecutePut(DmxController dmx, HttpListenerRequest request)
         {
-            if (!request.HasEntityBody || request.ContentLength64 != 1024)
+            bool binary = IsBinary(request);
+            if (!request.HasEntityBody || request.ContentLength64 != (binary ? 512 : 1024))
             {
                 return new Result
                 {
                     Code = HttpStatusCode.BadRequest,
-                    Content = "Expected 1024 ASCII characters encoding 512 bytes of data in request body"
+                    Content = binary ?
+                        "Expected 512 bytes of data in application/octet-stream request body" :
+                        "Expected 1024 ASCII characters encoding 512 bytes of data in request body"
                 };
             }
-            long n = request.ContentLength64;
-            var buffer = new byte[1024];
-            request.InputStream.Read(buffer, 0, buffer.Length);
 
             byte[] newData;
             try
             {
-                newData = Enumerable.Range(0, 512).Select(i => (byte)(DIGITS[buffer[2 * i]] * 0x10 + DIGITS[buffer[2 * i + 1]])).ToArray();
+                var buffer = ReadBody(request);
+                newData = binary ? buffer :
+                    Enumerable.Range(0, 512).Select(i => (byte)(DIGITS[buffer[2 * i]] * 0x10 + DIGITS[buffer[2 * i + 1]])).ToArray();
             } catch (Exception ex)
             {
                 return new Result
@@ -203,6 +230,74 @@ namespace DmxServer
             };
         }
 
+        // Body is a sequence of spans, each a big-endian 16-bit start channel and
+        // 16-bit length followed by that many bytes of channel data
+        static Result ExecutePutSpans(DmxController dmx, HttpListenerRequest request)
+        {
+            if (!request.HasEntityBody || !IsBinary(request))
+            {
+                return new Result
+                {
+                    Code = HttpStatusCode.BadRequest,
+                    Content = "Expected application/octet-stream request body containing DMX spans"
+                };
+            }
+
+            var spans = new List<KeyValuePair<int, byte[]>>();
+            try
+            {
+                var buffer = ReadBody(request);
+                int offset = 0;
+                while (offset < buffer.Length)
+                {
+                    if (offset + 4 > buffer.Length)
+                    {
+                        throw new ArgumentException("Truncated span header at byte " + offset);
+                    }
+                    int start = buffer[offset] * 0x100 + buffer[offset + 1];
+                    int length = buffer[offset + 2] * 0x100 + buffer[offset + 3];
+                    offset += 4;
+                    if (start + length > 512)
+                    {
+                        throw new ArgumentException("Span of " + length + " channels starting at " + start + " exceeds 512 channels");
+                    }
+                    if (offset + length > buffer.Length)
+                    {
+                        throw new ArgumentException("Truncated span data for channel " + start);
+                    }
+                    var data = new byte[length];
+                    Array.Copy(buffer, offset, data, 0, length);
+                    spans.Add(new KeyValuePair<int, byte[]>(start, data));
+                    offset += length;
+                }
+            } catch (Exception ex)
+            {
+                return new Result
+                {
+                    Code = HttpStatusCode.BadRequest,
+                    Content = ex.Message
+                };
+            }
+
+            try
+            {
+                dmx.SetSpans(spans);
+            } catch (Exception ex)
+            {
+                return new Result
+                {
+                    Code = HttpStatusCode.InternalServerError,
+                    Content = "Error setting DMX spans: " + ex.Message
+                };
+            }
+
+            return new Result
+            {
+                Code = HttpStatusCode.OK,
+                Content = "OK"
+            };
+        }
+
         struct Result
         {
             public HttpStatusCode Code;
@@ -264,6 +359,24 @@ namespace DmxServer
                 }
             }
 
+            public void SetSpans(IEnumerable<KeyValuePair<int, byte[]>> spans)
+            {
+                lock (_DmxData)
+                {
+                    foreach (var span in spans)
+                    {
+                        if (span.Key == 0 && span.Value.Length > 0 && span.Value[0] != 0)
+                        {
+                            throw new ArgumentException("DMX channel 0 may only have value 0");
+                        }
+                    }
+                    foreach (var span in spans)
+                    {
+                        Array.Copy(span.Value, 0, _DmxData, span.Key, span.Value.Length);
+                    }
+                }
+            }
+
             private void SendLoop()
             {
                 while (true)
@@ -1,9 +1,12 @@
+import argparse
 import logging
 import math
 import random
-import time
 from blinker import Blinker
+from metrics import Registry
 from panels import PanelA
+from recording import Recorder
+from scheduler import default_scheduler
 
 
 logger = logging.getLogger(__name__)
@@ -14,6 +17,9 @@ RED_SWITCHES = ('R0', 'R1', 'R2')
 GREEN_SWITCHES = ('G0', 'G1', 'G2')
 BLUE_SWITCHES = ('B0', 'B1', 'B2')
 
+PANEL = PanelA
+PORT = '/dev/ttyACM0'
+
 THROTTLE = '0'
 THROTTLE_ZERO = 20
 RED_MIN = 70
@@ -25,6 +31,18 @@ GREEN_MIN = 60
 GREEN_MAX = 90
 GREEN_RAMP = 2
 GREEN_DWELL = 0.5
+RAMP_INDICATORS = (('Q0', '3'), ('Q1', '3'), ('Q2', '3'), ('Q3', '3'), ('Q0', '2'), ('Q1', '2'), ('Q2', '2'),
+                   ('Q3', '2'), ('Q0', '7'), ('Q1', '7'), ('Q2', '7'))
+SLIDER = '0'
+SLIDER_DEADBAND = 3
+STATE_SAVE_INTERVAL = 5
+WRITE_QUEUE_SIZE = 64
+HEARTBEAT = 2
+
+
+def slider_curve(x):
+    v = 0.000770032 * math.exp(0.00628978 * x) - 0.00127362
+    return min(max(v, 0), 1)
 
 
 class SystemState(object):
@@ -36,6 +54,10 @@ class SystemState(object):
                                       lambda: self.panel.set_indicator('S1', False)), 1)
         self.red_ready = False
         self.green_ready = False
+        self.launching = False
+        self.deferred_switches = set()
+        self.panel.configure_analog(SLIDER, deadband=SLIDER_DEADBAND, calibration=slider_curve)
+        self.panel.set_analog_push(SLIDER)
         self.panel.set_servo(THROTTLE, THROTTLE_ZERO)
         self.reset()
 
@@ -63,84 +85,146 @@ class SystemState(object):
             self.panel.set_indicator(s, False)
 
     def switches_changed(self, changed_switches):
+        if self.launching:
+            # Switches flipped during a launch are handled against the new targets once it ends
+            self.deferred_switches.update(changed_switches)
+            return
         for switch in changed_switches:
             if switch in RED_SWITCHES:
-                panel.set_indicator(switch, panel.get_switch(switch) == self.red_target[switch])
+                self.panel.set_indicator(switch, self.panel.get_switch(switch) == self.red_target[switch])
             if switch in GREEN_SWITCHES:
-                panel.set_indicator(switch, panel.get_switch(switch) == self.green_target[switch])
+                self.panel.set_indicator(switch, self.panel.get_switch(switch) == self.green_target[switch])
             if switch in BLUE_SWITCHES:
                 self.blue_active[switch] = True
-                panel.set_indicator(switch, True)
-        red_ready = all(panel.get_switch(k) == v for k, v in self.red_target.items())
-        green_ready = all(panel.get_switch(k) == v for k, v in self.green_target.items())
+                self.panel.set_indicator(switch, True)
+        red_ready = all(self.panel.get_switch(k) == v for k, v in self.red_target.items())
+        green_ready = all(self.panel.get_switch(k) == v for k, v in self.green_target.items())
 
         if red_ready:
             self.red_blinker.blink(4)
-            if 'S0' in changed_switches and panel.get_switch('S0'):
+            if 'S0' in changed_switches and self.panel.get_switch('S0'):
                 # Red launch button pressed
                 peak_max = RED_MAX
                 if self.boost():
                     peak_max += RED_BOOST
                 peak = RED_MIN + self.read_slider() * (RED_MAX - RED_MIN)
                 self.launch('S0', RED_RAMP, peak, RED_DWELL)
-                self.reset()
+                return
         else:
             self.red_blinker.stop()
 
         if green_ready:
             self.green_blinker.blink(4)
-            if 'S1' in changed_switches and panel.get_switch('S1'):
+            if 'S1' in changed_switches and self.panel.get_switch('S1'):
                 # Green launch button pressed
                 peak = GREEN_MIN + self.read_slider() * (GREEN_MAX - GREEN_MIN)
                 self.launch('S1', GREEN_RAMP, peak, GREEN_DWELL)
-                self.reset()
+                return
         else:
             self.green_blinker.stop()
 
     def read_slider(self):
-        x = self.panel.read_analog('0')
-        v = 0.000770032 * math.exp(0.00628978 * x) - 0.00127362
-        return min(max(v, 0), 1)
+        return self.panel.get_calibrated(SLIDER)
 
     def boost(self):
         #return all(self.blue_active) and all(not self.panel.get_switch(s) for s in BLUE_SWITCHES)
         return all(not self.panel.get_switch(s) for s in BLUE_SWITCHES)
 
+    # Runs the launch sequence on scheduler timers so the control loop keeps serving input
     def launch(self, launch_button, ramp, peak, hold):
+        self.launching = True
+        self.red_blinker.stop()
+        self.green_blinker.stop()
         for s in self.panel.BINARY_INDICATORS:
             self.panel.set_indicator(s, s == launch_button)
         for q in self.panel.COLORED_LEDS:
             self.panel.set_indicator(q, '1')
-        ramp_indicators = (('Q0', '3'), ('Q1', '3'), ('Q2', '3'), ('Q3', '3'), ('Q0', '2'), ('Q1', '2'), ('Q2', '2'), ('Q3', '2'), ('Q0', '7'), ('Q1', '7'), ('Q2', '7'))
-        for i in range(11):
-            self.panel.set_servo(THROTTLE, i * (peak - THROTTLE_ZERO) / 10 + THROTTLE_ZERO)
-            time.sleep(ramp / 10)
-            self.panel.set_indicator(ramp_indicators[i][0], ramp_indicators[i][1])
+        self.panel.move_servo(THROTTLE, peak, ramp)
+        for i, (q, color) in enumerate(RAMP_INDICATORS):
+            default_scheduler.call_later((i + 1) * ramp / 10, lambda q=q, color=color: self.panel.set_indicator(q, color))
+        end_ramp = len(RAMP_INDICATORS) * ramp / 10
+        default_scheduler.call_later(end_ramp, self.launch_peak)
+        default_scheduler.call_later(end_ramp + max(0, hold - 0.1), self.launch_done)
+
+    def launch_peak(self):
         self.panel.set_indicator('Q3', '7')
         if self.boost():
             self.panel.set_indicator('A0', '1')
-        time.sleep(max(0, hold - 0.1))
+
+    def launch_done(self):
         for q in self.panel.COLORED_LEDS:
             self.panel.set_indicator(q, '0')
         self.panel.set_servo(THROTTLE, THROTTLE_ZERO)
+        self.launching = False
+        self.reset()
+        if self.deferred_switches:
+            changed_switches = self.deferred_switches
+            self.deferred_switches = set()
+            self.switches_changed(changed_switches)
 
-    def update(self):
-        self.red_blinker.update()
-        self.green_blinker.update()
-
+def create_system(panel, dmx=None):
+    return SystemState(panel)
 
-logger.info("Initializing panel connection")
-panel = PanelA('/dev/ttyACM0')
-system = SystemState(panel)
 
-while True:
-    changed_switches = panel.changed_switches()
+def step(panel, system, max_timeout=None):
+    changed_switches = panel.changed_switches(timeout=default_scheduler.timeout(max_timeout))
     if changed_switches:
         system.switches_changed(changed_switches)
-    system.update()
-
-
-logger.info("Closing panel connection")
-del panel
-
-logger.info("Done.")
+    default_scheduler.run_pending()
+    panel.flush()
+
+
+# Saves the panel's inputs every STATE_SAVE_INTERVAL seconds; returns a function that stops saving
+def start_state_saving(panel):
+    timer = [None]
+
+    def save():
+        panel.save_state()
+        timer[0] = default_scheduler.call_later(STATE_SAVE_INTERVAL, save)
+
+    timer[0] = default_scheduler.call_later(STATE_SAVE_INTERVAL, save)
+    return lambda: default_scheduler.cancel(timer[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PanelA launch game')
+    parser.add_argument('--port', default=PORT, help='Serial port of the panel')
+    parser.add_argument('--metrics', type=float, metavar='SECONDS',
+                        help='Log latency and throughput metrics every SECONDS')
+    parser.add_argument('--record', metavar='FILE', help='Record panel I/O to FILE for later replay')
+    parser.add_argument('--state', metavar='FILE',
+                        help='Start from the panel inputs saved in FILE and keep it up to date')
+    args = parser.parse_args()
+
+    recorder = None if args.record is None else Recorder(args.record)
+    metrics = None
+    if args.metrics:
+        metrics = Registry()
+        metrics.start_logging(args.metrics)
+    logger.info("Initializing panel connection")
+    panel = PANEL(args.port, autoflush=False, recorder=recorder, metrics=metrics, state_file=args.state,
+                  queue_size=WRITE_QUEUE_SIZE, heartbeat=HEARTBEAT)
+    system = create_system(panel)
+    stop_saving = None
+    if args.state is not None:
+        stop_saving = start_state_saving(panel)
+
+    try:
+        while True:
+            step(panel, system)
+    except KeyboardInterrupt:
+        pass
+
+    logger.info("Closing panel connection")
+    if stop_saving is not None:
+        stop_saving()
+        panel.save_state()
+    panel.close()
+    if recorder is not None:
+        recorder.close()
+
+    logger.info("Done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,22 @@
+import argparse
 import logging
-import math
-import random
-import time
-from blinker import Blinker
+from animation import AnimationEngine
+from cues import CueEngine
 from dmx import DmxClient
+from metrics import Registry
 from panels import PanelB
-from scroller import Scroller
+from recording import Recorder
+from scheduler import default_scheduler
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+PANEL = PanelB
+PORT = '/dev/ttyUSB0'
+DMX_URL = 'http://192.168.1.79:8080'
+
 PAN_CHANNEL = 1
 PAN_MIN = 0
 PAN_MAX = 540
@@ -48,19 +53,29 @@ AUTO_CHANNEL = 10
 AUTO_SWITCHES = ('00', '01', '02')
 AUTO_MODES = (60, 160, 135)
 AUTO_DISABLE = 0
+STATE_SAVE_INTERVAL = 5
+HEARTBEAT = 2
+
+HOME_SCENE = 'home'
 
 
 class SystemState(object):
     def __init__(self, panel, dmx):
         self.panel = panel
         self.dmx = dmx
-        self.pan = Scroller(PAN_MIN, PAN_MAX)
-        self.tilt = Scroller(TILT_MIN, TILT_MAX)
+        self.animation = AnimationEngine(dmx)
+        self.pan = self.animation.add_channel(PAN_CHANNEL, PAN_MIN, PAN_MAX, PAN_FULL_SPAN, bits=16)
+        self.tilt = self.animation.add_channel(TILT_CHANNEL, TILT_MIN, TILT_MAX, TILT_FULL_SPAN, bits=16)
         self.color_index = 0
         self.gobo_index = 0
-        self.brightness = Scroller(0, 255, 255 / 3.0)
+        self.brightness = self.animation.add_channel(BRIGHTNESS_CHANNEL, 0, 255, speed=255 / 3.0)
         self.brightness_direction = 1
         self.is_auto = False
+        self.cues = CueEngine(dmx)
+        self.cues.add_scene(HOME_SCENE, {COLOR_CHANNEL: COLORS[0], GOBO_CHANNEL: GOBOS[0], AUTO_CHANNEL: AUTO_DISABLE})
+        for sw, mode in zip(AUTO_SWITCHES, AUTO_MODES):
+            self.cues.add_scene(sw, {AUTO_CHANNEL: mode})
+        self.animation.write()
 
     def switch_changed(self, switch, value):
         if switch == JOY_UP:
@@ -116,15 +131,13 @@ class SystemState(object):
                 self.brightness.value = 0
                 self.brightness_direction = 1
                 self.color_index = 0
-                self.dmx[COLOR_CHANNEL] = COLORS[0]
                 self.gobo_index = 0
-                self.dmx[GOBO_CHANNEL] = GOBOS[0]
+                self.cues.go(HOME_SCENE)
         elif switch in AUTO_SWITCHES and value:
             self.set_auto_mode(True)
-            for sw, mode in zip(AUTO_SWITCHES, AUTO_MODES):
+            for sw in AUTO_SWITCHES:
                 self.panel.set_indicator(sw, sw == switch)
-                if sw == switch:
-                    self.dmx[AUTO_CHANNEL] = mode
+            self.cues.go(switch)
 
     def set_auto_mode(self, is_auto):
         if self.is_auto and not is_auto:
@@ -134,31 +147,89 @@ class SystemState(object):
         elif not self.is_auto and is_auto:
             pass
         self.is_auto = is_auto
-
-    def update(self):
-        if not self.is_auto:
-            self.dmx.set16(PAN_CHANNEL, self.pan.value / PAN_FULL_SPAN)
-            self.dmx.set16(TILT_CHANNEL, self.tilt.value / TILT_FULL_SPAN)
-            self.dmx[BRIGHTNESS_CHANNEL] = self.brightness.value
+        self.animation.enabled = not is_auto
 
 
-logger.info("Initializing panel connection")
-panel = PanelB('/dev/ttyUSB0')
-logger.info("Initializing DMX server connection")
-dmx = DmxClient('http://192.168.1.79:8080')
-dmx.start()
+def create_system(panel, dmx=None):
+    if dmx is None:
+        dmx = DmxClient(DMX_URL, encoding='delta')
+    return SystemState(panel, dmx)
 
-system = SystemState(panel, dmx)
 
-while True:
-    changed_switches = panel.changed_switches()
+def step(panel, system, max_timeout=None):
+    changed_switches = panel.changed_switches(timeout=default_scheduler.timeout(max_timeout))
     for switch in changed_switches:
         system.switch_changed(switch, panel.get_switch(switch))
-    system.update()
-    time.sleep(0.1)
-
-
-logger.info("Closing panel connection")
-del panel
-
-logger.info("Done.")
+    default_scheduler.run_pending()
+    panel.flush()
+
+
+# Saves the panel's inputs every STATE_SAVE_INTERVAL seconds; returns a function that stops saving
+def start_state_saving(panel):
+    timer = [None]
+
+    def save():
+        panel.save_state()
+        timer[0] = default_scheduler.call_later(STATE_SAVE_INTERVAL, save)
+
+    timer[0] = default_scheduler.call_later(STATE_SAVE_INTERVAL, save)
+    return lambda: default_scheduler.cancel(timer[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PanelB moving light controller')
+    parser.add_argument('--port', default=PORT, help='Serial port of the panel')
+    parser.add_argument('--dmx', default=DMX_URL, help='Base URL of the DMX server')
+    parser.add_argument('--dmx-process', action='store_true',
+                        help='Send DMX frames from a separate process through a shared-memory universe')
+    parser.add_argument('--metrics', type=float, metavar='SECONDS',
+                        help='Log latency and throughput metrics every SECONDS')
+    parser.add_argument('--record', metavar='FILE', help='Record panel I/O and DMX frames to FILE for later replay')
+    parser.add_argument('--state', metavar='FILE',
+                        help='Start from the panel inputs saved in FILE and keep it up to date')
+    args = parser.parse_args()
+
+    recorder = None if args.record is None else Recorder(args.record)
+    metrics = None
+    if args.metrics:
+        metrics = Registry()
+        metrics.start_logging(args.metrics)
+    logger.info("Initializing panel connection")
+    panel = PANEL(args.port, autoflush=False, recorder=recorder, metrics=metrics, state_file=args.state,
+                  heartbeat=HEARTBEAT)
+    logger.info("Initializing DMX server connection")
+    if args.dmx_process:
+        # Only the process mode needs multiprocessing, so it is imported on demand
+        from dmxprocess import ProcessDmxClient
+        dmx = ProcessDmxClient(args.dmx, encoding='delta', metrics=metrics)
+    else:
+        dmx = DmxClient(args.dmx, encoding='delta', recorder=recorder, metrics=metrics)
+    dmx.start()
+
+    system = create_system(panel, dmx)
+    stop_saving = None
+    if args.state is not None:
+        stop_saving = start_state_saving(panel)
+
+    try:
+        while True:
+            step(panel, system)
+    except KeyboardInterrupt:
+        pass
+
+    logger.info("Closing panel connection")
+    if stop_saving is not None:
+        stop_saving()
+        panel.save_state()
+    dmx.stop()
+    if args.dmx_process:
+        dmx.close()
+    panel.close()
+    if recorder is not None:
+        recorder.close()
+
+    logger.info("Done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+import urllib.parse
+from dmx import DmxClient, FRAME_RATE, SEND_TIMEOUT, frame_start
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+
+class AsyncDmxClient(DmxClient):
+    def __init__(self, base_url, encoding='hex', timeout=SEND_TIMEOUT, frame_rate=FRAME_RATE, recorder=None,
+                 metrics=None):
+        super(AsyncDmxClient, self).__init__(base_url, encoding, timeout, frame_rate, recorder, metrics)
+        url = urllib.parse.urlsplit(base_url)
+        self._host = url.hostname
+        self._port = url.port or 80
+        self._netloc = url.netloc
+        self._prefix = url.path.rstrip('/') + '/'
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._dirty = asyncio.Event()
+        self._dirty.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._update_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._disconnect()
+
+    async def _update_loop(self):
+        period = 1.0 / self.frame_rate
+        next_frame = time.monotonic()
+        while True:
+            await self._dirty.wait()
+            now = time.monotonic()
+            next_frame = frame_start(next_frame, period, now)
+            wait = max(next_frame, self._retry_at) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._send_frame()
+            next_frame = self._next_frame_time(next_frame, period)
+
+    async def _send_frame(self):
+        frame = self._take_frame()
+        if frame is None:
+            return True
+        path, data, headers = self._encode(frame)
+        t0 = time.monotonic()
+        try:
+            status = await asyncio.wait_for(self._post(path, data, headers), self.timeout)
+            if status >= 400:
+                raise IOError('DMX server returned HTTP %d' % status)
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            self._disconnect()
+            self._send_failed(e)
+            return False
+        self._send_succeeded(frame, t0)
+        return True
+
+    async def _post(self, path, data, headers):
+        reused = self._writer is not None
+        try:
+            return await self._request(path, data, headers)
+        except (OSError, asyncio.IncompleteReadError):
+            if not reused:
+                raise
+        # The server may have closed an idle keep-alive connection; retry once on a fresh one
+        self._disconnect()
+        return await self._request(path, data, headers)
+
+    async def _request(self, path, data, headers):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        lines = ['POST %s%s HTTP/1.1' % (self._prefix, path),
+                 'Host: %s' % self._netloc,
+                 'Content-Length: %d' % len(data)]
+        lines.extend('%s: %s' % item for item in (headers or {}).items())
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('ascii') + data)
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError('DMX server closed the connection')
+        status = int(status_line.split()[1])
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        await self._reader.readexactly(length)
+        return status
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    def __del__(self):
+        self._disconnect()
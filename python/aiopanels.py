@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import time
+import serial
+from panels import Change
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+
+class AsyncPanel(object):
+    def __init__(self, layout, autoflush=True):
+        self.layout = layout
+        self.autoflush = autoflush
+        self._ser = None
+        self._fd = None
+        self._loop = None
+        self._in = bytearray()
+        self._out = bytearray()
+        self._values = {}
+        self._value_futures = {}
+        self._changes = {layout.SWITCH_KIND: {}, layout.ANALOG_KIND: {}}
+        self._subscribers = ()
+        self._outputs = {}
+        self._pending_outputs = {}
+
+    @classmethod
+    async def open(cls, layout, port, autoflush=True):
+        panel = cls(layout, autoflush)
+        await panel.connect(port)
+        return panel
+
+    async def connect(self, port):
+        self._loop = asyncio.get_event_loop()
+        self._ser = serial.Serial(port, baudrate=self.layout.BAUDRATE, timeout=0)
+        self._fd = self._ser.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+        logger.info("Waiting for READY")
+        await self.wait_ready()
+        logger.info("Initializing switches and analogs")
+        await self.read_all()
+        logger.info("Initialization complete")
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._fd = None
+        self._ser.close()
+        for pending in self._value_futures.values():
+            for future in pending:
+                if not future.done():
+                    future.set_exception(ConnectionError("%s connection closed" % self.layout.__name__))
+        self._value_futures.clear()
+
+    def send_command(self, cmd):
+        self.send_commands((cmd,))
+
+    def send_commands(self, cmds):
+        logger.debug("Commands: %s", ' '.join(cmds))
+        self._write(''.join(cmd + '\n' for cmd in cmds).encode('ascii'))
+
+    def flush(self):
+        if not self._pending_outputs:
+            return
+        data = b''.join(self._pending_outputs.values())
+        self._outputs.update(self._pending_outputs)
+        self._pending_outputs.clear()
+        logger.debug("Outputs: %s", data)
+        self._write(data)
+
+    async def wait_ready(self, timeout=None):
+        future = self._query_values(((self.layout.READY_KEY, '*READY'),))
+        await self._wait_values(future, self.layout.READY_TIMEOUT if timeout is None else timeout)
+
+    def set_indicator(self, indicator, value):
+        self._set_output(*self.layout._indicator_command(indicator, value))
+
+    def set_servo(self, servo, value):
+        self._set_output(*self.layout._servo_command(servo, value))
+
+    async def read_switch(self, switch, timeout=None):
+        return (await self.read_all((switch,), (), timeout))[0][switch]
+
+    async def read_analog(self, analog, timeout=None):
+        return (await self.read_all((), (analog,), timeout))[1][analog]
+
+    def get_switch(self, switch):
+        if switch not in self.layout.SWITCHES:
+            raise ValueError("Switch '%s' does not exist in %s" % (switch, self.layout.__name__))
+        return self._values[self.layout._switch_key(switch)]
+
+    def get_analog(self, analog):
+        if analog not in self.layout.ANALOGS:
+            raise ValueError("Analog input '%s' does not exist in %s" % (analog, self.layout.__name__))
+        return self._values[self.layout._analog_key(analog)]
+
+    def query(self, switches=(), analogs=()):
+        switches = list(switches)
+        analogs = list(analogs)
+        requests = []
+        for switch in switches:
+            if switch not in self.layout.SWITCHES:
+                raise ValueError("Switch '%s' does not exist in %s" % (switch, self.layout.__name__))
+            requests.append((self.layout._switch_key(switch), 'QS%s' % switch))
+        for analog in analogs:
+            if analog not in self.layout.ANALOGS:
+                raise ValueError("Analog input '%s' does not exist in %s" % (analog, self.layout.__name__))
+            requests.append((self.layout._analog_key(analog), 'QA%s' % analog))
+        pending = self._query_values(requests)
+        return dict(zip(switches, pending[:len(switches)])), dict(zip(analogs, pending[len(switches):]))
+
+    async def read_all(self, switches=None, analogs=None, timeout=None):
+        switch_futures, analog_futures = self.query(
+            self.layout.SWITCHES if switches is None else switches,
+            self.layout.ANALOGS if analogs is None else analogs)
+        await self._wait_values(list(switch_futures.values()) + list(analog_futures.values()), timeout)
+        return ({s: f.result() for s, f in switch_futures.items()},
+                {a: f.result() for a, f in analog_futures.items()})
+
+    def changed_switches(self):
+        return self._pop_changes(self.layout.SWITCH_KIND)
+
+    def changed_analogs(self):
+        return self._pop_changes(self.layout.ANALOG_KIND)
+
+    def subscribe(self, callback):
+        self._subscribers += (callback,)
+
+    def unsubscribe(self, callback):
+        self._subscribers = tuple(s for s in self._subscribers if s != callback)
+
+    async def changes(self):
+        queue = asyncio.Queue()
+        self.subscribe(queue.put_nowait)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(queue.put_nowait)
+
+    def _write(self, data):
+        if self._fd is None:
+            raise ConnectionError("%s connection closed" % self.layout.__name__)
+        if not self._out:
+            try:
+                n = os.write(self._fd, data)
+            except BlockingIOError:
+                n = 0
+            if n == len(data):
+                return
+            data = data[n:]
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._out += data
+
+    def _on_writable(self):
+        try:
+            n = os.write(self._fd, self._out)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error("Error writing to %s: %s" % (self.layout.__name__, e))
+            self.close()
+            return
+        del self._out[:n]
+        if not self._out:
+            self._loop.remove_writer(self._fd)
+
+    def _on_readable(self):
+        try:
+            chunk = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            chunk = b''
+            logger.error("Error reading from %s: %s" % (self.layout.__name__, e))
+        if not chunk:
+            self.close()
+            return
+        self._in += chunk
+        end = self._in.rfind(b'\n')
+        if end < 0:
+            return
+        lines = bytes(self._in[:end]).split(b'\n')
+        del self._in[:end + 1]
+        table = self.layout._decode_table()
+        for line in lines:
+            decoded = table.get(line)
+            if decoded is None and line:
+                decoded = self.layout._decode_message(line.decode('ascii', 'replace'))
+            if decoded is not None:
+                self._update_value(*decoded)
+
+    def _set_output(self, target, cmd):
+        if self._outputs.get(target) == cmd:
+            self._pending_outputs.pop(target, None)
+        else:
+            self._pending_outputs[target] = cmd
+        if self.autoflush:
+            self.flush()
+
+    def _update_value(self, key, value, kind=None, name=None, slot=None):
+        # As in Panel, an input is a change when first reported and then only when its value differs
+        changed = kind is not None and (key not in self._values or self._values[key] != value)
+        self._values[key] = value
+        for future in self._value_futures.pop(key, ()):
+            if not future.done():
+                future.set_result(value)
+        if changed:
+            self._changes[kind][name] = None
+            if self._subscribers:
+                change = Change(kind, name, value, time.monotonic())
+                for callback in self._subscribers:
+                    try:
+                        callback(change)
+                    except Exception as e:
+                        logger.error("Error in change subscriber %s: %s" % (callback, e))
+
+    def _query_values(self, requests):
+        pending = []
+        for key, cmd in requests:
+            future = self._loop.create_future()
+            future.key = key
+            future.cmd = cmd
+            self._value_futures.setdefault(key, []).append(future)
+            pending.append(future)
+        if requests:
+            self.send_commands([cmd for key, cmd in requests])
+        return pending
+
+    async def _wait_values(self, pending, timeout=None):
+        if timeout is None:
+            timeout = self.layout.QUERY_TIMEOUT
+        if not pending:
+            return []
+        done, not_done = await asyncio.wait(pending, timeout=timeout)
+        if not_done:
+            for future in not_done:
+                waiting = self._value_futures.get(future.key, [])
+                if future in waiting:
+                    waiting.remove(future)
+                    if not waiting:
+                        del self._value_futures[future.key]
+                future.cancel()
+            raise TimeoutError("No response to %s from %s within %gs" % (
+                ', '.join(sorted(f.cmd for f in not_done)), self.layout.__name__, timeout))
+        return [future.result() for future in pending]
+
+    def _pop_changes(self, kind):
+        changes = self._changes[kind]
+        changed = list(changes)
+        changes.clear()
+        return changed
@@ -0,0 +1,176 @@
+import numpy as np
+from scheduler import default_scheduler
+
+
+UPDATE_INTERVAL = 0.02
+
+
+class AnimatedChannel(object):
+    def __init__(self, engine, index):
+        self._engine = engine
+        self.index = index
+
+    def scroll_down(self, scroll=True):
+        self.scroll(-1, scroll)
+
+    def scroll_up(self, scroll=True):
+        self.scroll(1, scroll)
+
+    def scroll(self, direction, scroll=True):
+        self._engine.scroll((self.index,), direction, scroll)
+
+    def scroll_stop(self):
+        self._engine.stop((self.index,))
+
+    def ramp(self, target, duration):
+        self._engine.ramp((self.index,), target, duration)
+
+    def get_value(self):
+        return float(self._engine.values()[self.index])
+
+    def set_value(self, value):
+        self._engine.set_values((self.index,), value)
+
+    value = property(get_value, set_value)
+
+    def get_speed(self):
+        return float(self._engine.speed[self.index])
+
+    def set_speed(self, speed):
+        self._engine.set_speed((self.index,), speed)
+
+    speed = property(get_speed, set_speed)
+
+
+class AnimationEngine(object):
+    def __init__(self, dmx, scheduler=None, interval=UPDATE_INTERVAL):
+        self.dmx = dmx
+        self._scheduler = default_scheduler if scheduler is None else scheduler
+        self._interval = interval
+        self._timer = None
+        self._enabled = True
+        self.min_value = np.zeros(0)
+        self.max_value = np.zeros(0)
+        self.speed = np.zeros(0)
+        self._span = np.zeros(0)
+        self._value0 = np.zeros(0)
+        self._t0 = np.zeros(0)
+        self._rate = np.zeros(0)
+        self._low = np.zeros(0)
+        self._high = np.zeros(0)
+        self._index8 = np.zeros(0, dtype=np.intp)
+        self._address8 = np.zeros(0, dtype=np.intp)
+        self._index16 = np.zeros(0, dtype=np.intp)
+        self._address16 = np.zeros(0, dtype=np.intp)
+
+    def add_channel(self, address, min_value, max_value, span=None, bits=8, speed=None):
+        if bits not in (8, 16):
+            raise ValueError("DMX channel width must be 8 or 16 bits, not %s" % bits)
+        index = len(self._value0)
+        if bits == 8:
+            self._index8 = np.append(self._index8, index)
+            self._address8 = np.append(self._address8, address)
+        else:
+            self._index16 = np.append(self._index16, index)
+            self._address16 = np.append(self._address16, address)
+        self.min_value = np.append(self.min_value, min_value)
+        self.max_value = np.append(self.max_value, max_value)
+        self.speed = np.append(self.speed, (max_value - min_value) / 10 if speed is None else speed)
+        self._span = np.append(self._span, max_value if span is None else span)
+        self._value0 = np.append(self._value0, min_value)
+        self._t0 = np.append(self._t0, self._scheduler.clock())
+        self._rate = np.append(self._rate, 0)
+        self._low = np.append(self._low, min_value)
+        self._high = np.append(self._high, max_value)
+        return AnimatedChannel(self, index)
+
+    def values(self, t=None):
+        if t is None:
+            t = self._scheduler.clock()
+        return np.clip(self._value0 + self._rate * (t - self._t0), self._low, self._high)
+
+    def moving(self, t=None):
+        v = self.values(t)
+        return bool(np.any((self._rate > 0) & (v < self._high) | (self._rate < 0) & (v > self._low)))
+
+    def scroll(self, channels, direction, scroll=True):
+        if not scroll:
+            self.stop(channels)
+            return
+        channels = np.asarray(channels, dtype=np.intp)
+        self._rebase(channels)
+        self._rate[channels] = direction * self.speed[channels]
+        self._low[channels] = self.min_value[channels]
+        self._high[channels] = self.max_value[channels]
+        self._changed()
+
+    def ramp(self, channels, targets, duration):
+        channels = np.asarray(channels, dtype=np.intp)
+        self._rebase(channels)
+        start = self._value0[channels]
+        targets = np.clip(targets, self.min_value[channels], self.max_value[channels])
+        if duration <= 0:
+            self._value0[channels] = targets
+            self._rate[channels] = 0
+        else:
+            self._rate[channels] = (targets - start) / duration
+        self._low[channels] = np.minimum(start, targets)
+        self._high[channels] = np.maximum(start, targets)
+        self._changed()
+
+    def stop(self, channels):
+        channels = np.asarray(channels, dtype=np.intp)
+        self._rebase(channels)
+        self._rate[channels] = 0
+        self._changed()
+
+    def set_values(self, channels, values):
+        channels = np.asarray(channels, dtype=np.intp)
+        self._t0[channels] = self._scheduler.clock()
+        self._value0[channels] = np.clip(values, self.min_value[channels], self.max_value[channels])
+        self._rate[channels] = 0
+        self._low[channels] = self.min_value[channels]
+        self._high[channels] = self.max_value[channels]
+        self._changed()
+
+    def set_speed(self, channels, speeds):
+        channels = np.asarray(channels, dtype=np.intp)
+        self._rebase(channels)
+        self._rate[channels] = np.sign(self._rate[channels]) * speeds
+        self.speed[channels] = speeds
+        self._changed()
+
+    def get_enabled(self):
+        return self._enabled
+
+    def set_enabled(self, enabled):
+        self._enabled = enabled
+        self._changed()
+
+    enabled = property(get_enabled, set_enabled)
+
+    def write(self, t=None):
+        v = self.values(t) / self._span
+        bytes8 = np.rint(np.clip(v[self._index8], 0, 1) * 0xff).astype(np.uint8)
+        words16 = np.rint(np.clip(v[self._index16], 0, 1) * 0xffff).astype(np.uint16)
+        with self.dmx.edit() as universe:
+            buf = np.frombuffer(universe, dtype=np.uint8)
+            buf[self._address8] = bytes8
+            buf[self._address16] = words16 >> 8
+            buf[self._address16 + 1] = words16 & 0xff
+            del buf
+
+    def _rebase(self, channels):
+        t = self._scheduler.clock()
+        self._value0[channels] = self.values(t)[channels]
+        self._t0[channels] = t
+
+    def _changed(self):
+        self._scheduler.cancel(self._timer)
+        self._timer = None
+        if not self._enabled:
+            return
+        t = self._scheduler.clock()
+        self.write(t)
+        if self.moving(t):
+            self._timer = self._scheduler.call_later(self._interval, self._changed)
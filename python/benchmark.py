@@ -0,0 +1,1210 @@
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import random
+import socket
+import threading
+import time
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import requests
+import dmx
+import hub
+import panels
+import PanelALauncher
+from aiodmx import AsyncDmxClient
+from aiopanels import AsyncPanel
+from dmx import DmxClient
+from dmxprocess import ProcessDmxClient
+from dmxserver import DmxServer
+from hub import PanelHub
+from metrics import Registry
+from animation import AnimationEngine
+from blinker import Blinker
+from cues import CueEngine
+from panels import PanelA, PanelB
+from recording import REPLAY_STALL, Recorder, read_frames, recording_files, replay
+from scheduler import Scheduler
+from scroller import Scroller
+from simulator import PanelSimulator
+from universes import UniverseManager
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+RESULTS = {}
+FAILURES = []
+
+
+# Records a result for --save/--compare; `higher_is_better` says which direction is a regression
+def record(name, value, unit, higher_is_better=False):
+    RESULTS[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+# Records a failed correctness check, which makes the run exit non-zero
+def check(name, ok, message):
+    if not ok:
+        logger.error("%s check failed: %s" % (name, message))
+        FAILURES.append(name)
+    return ok
+
+
+class FakeSerial(object):
+    def __init__(self):
+        self._buf = bytearray()
+        self._cv = threading.Condition()
+        self._closed = False
+
+    @property
+    def in_waiting(self):
+        return len(self._buf)
+
+    def read(self, size=1):
+        with self._cv:
+            while not self._buf:
+                if self._closed:
+                    raise IOError("Fake serial port closed")
+                self._cv.wait()
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+        return data
+
+    def write(self, data):
+        replies = []
+        for cmd in data.decode('ascii').split('\n'):
+            if cmd == '*READY':
+                replies.append(cmd)
+            elif cmd.startswith('QS'):
+                replies.append('S%sU' % cmd[2:])
+            elif cmd.startswith('QA'):
+                replies.append('A%s00' % cmd[2:])
+        if replies:
+            self.feed(''.join(r + '\n' for r in replies).encode('ascii'))
+        return len(data)
+
+    def feed(self, data):
+        with self._cv:
+            self._buf += data
+            self._cv.notify()
+
+    def close(self):
+        with self._cv:
+            self._closed = True
+            self._cv.notify()
+
+
+def legacy_listen_loop(panel):
+    buf = b''
+    while True:
+        try:
+            c = panel._ser.read()
+        except Exception:
+            break
+        if c == b'\n':
+            panel._on_message(buf.decode('ascii'))
+            buf = b''
+        else:
+            buf += c
+
+
+class LegacyPanelA(PanelA):
+    def _listen_loop(self):
+        legacy_listen_loop(self)
+
+
+class LegacyPanelB(PanelB):
+    def _listen_loop(self):
+        legacy_listen_loop(self)
+
+
+def make_messages(panel_class, n, analog_fraction=0.5):
+    switches = sorted(panel_class.SWITCHES)
+    analogs = sorted(panel_class.ANALOGS)
+    digits = panel_class.ANALOG_DIGITS
+    rnd = random.Random(0)
+    msgs = []
+    for _ in range(n):
+        if analogs and rnd.random() < analog_fraction:
+            msgs.append('A%s%s%s' % (rnd.choice(analogs), rnd.choice(digits), rnd.choice(digits)))
+        else:
+            msgs.append('S%s%s' % (rnd.choice(switches), rnd.choice('DU')))
+    return msgs
+
+
+def time_listen(panel_class, msgs, recorder=None, metrics=None):
+    ser = FakeSerial()
+    panel = panel_class(ser, recorder=recorder, metrics=metrics)
+    data = ''.join(m + '\n' for m in msgs).encode('ascii')
+    t0 = time.perf_counter()
+    ser.feed(data)
+    panel.wait_ready()
+    dt = time.perf_counter() - t0
+    panel.close()
+    return dt
+
+
+def bench_listen(args):
+    for name, current, legacy in (('PanelA', PanelA, LegacyPanelA), ('PanelB', PanelB, LegacyPanelB)):
+        msgs = make_messages(current, args.messages)
+        t_legacy = time_listen(legacy, msgs)
+        t_current = time_listen(current, msgs)
+        logger.info("listen %s: legacy %.0f lines/s, current %.0f lines/s (%.1fx)" % (
+            name, len(msgs) / t_legacy, len(msgs) / t_current, t_legacy / t_current))
+        record('listen.%s' % name, len(msgs) / t_current, 'lines/s', True)
+
+
+def time_decode(decode, lines, repeat=5):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        decode(lines)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def legacy_decode(panel, lines):
+    for line in lines:
+        panel._on_message(line.decode('ascii'))
+
+
+# Runs one decoder over the lines on a fresh panel; returns the changes it reported and the final state
+def decode_changes(panel_class, lines, legacy):
+    panel = panel_class(FakeSerial())
+    changes = []
+    panel.subscribe(changes.append)
+    if legacy:
+        legacy_decode(panel, lines)
+    else:
+        panel._on_lines(lines)
+    state = panel.snapshot()
+    panel.close()
+    return [(c.kind, c.name, c.value) for c in changes], state
+
+
+def bench_decode(args):
+    for name, panel_class, analog_fraction in (('PanelA', PanelA, 0.8), ('PanelB', PanelB, 0.0)):
+        panel = panel_class(FakeSerial())
+        lines = [m.encode('ascii') for m in make_messages(panel_class, args.messages, analog_fraction)]
+        t_legacy = time_decode(lambda lines: legacy_decode(panel, lines), lines)
+        t_current = time_decode(panel._on_lines, lines)
+        panel.close()
+        logger.info("decode %s: legacy %.2f us/msg, table %.2f us/msg (%.1fx)" % (
+            name, 1e6 * t_legacy / len(lines), 1e6 * t_current / len(lines), t_legacy / t_current))
+        record('decode.%s' % name, 1e6 * t_current / len(lines), 'us/msg')
+
+        legacy_changes, legacy_state = decode_changes(panel_class, lines, True)
+        table_changes, table_state = decode_changes(panel_class, lines, False)
+        check('decode.%s.changes' % name, table_changes == legacy_changes,
+              "table decoder reported %d changes, legacy %d" % (len(table_changes), len(legacy_changes)))
+        check('decode.%s.state' % name, table_state == legacy_state,
+              "table and legacy decoders end in different states")
+
+
+def percentiles(samples, ps=(50, 90, 99)):
+    samples = sorted(samples)
+    return [samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in ps]
+
+
+def format_ms(samples):
+    return '/'.join('%.2f' % (1e3 * v) for v in percentiles(samples)) + ' ms (p50/p90/p99)'
+
+
+class LegacyDmxClient(DmxClient):
+    def _send_frame(self):
+        with self._lock:
+            frame = bytes(self._dmx)
+            self._dirty.clear()
+            path, data, headers = self._encode(frame)
+            r = requests.post(os.path.join(self.base_url, path), data=data, headers=headers)
+        r.raise_for_status()
+        return True
+
+
+def bench_dmx(args):
+    server = DmxServer().start()
+    for name, client_class in (('legacy', LegacyDmxClient), ('current', DmxClient)):
+        client = client_class(server.url)
+        send_times = []
+        for i in range(args.frames):
+            client[1] = i % 256
+            t0 = time.perf_counter()
+            client._send_frame()
+            send_times.append(time.perf_counter() - t0)
+        logger.info("dmx %s: send latency %s" % (name, format_ms(send_times)))
+    record('dmx.send_p50', 1e3 * percentiles(send_times)[0], 'ms')
+
+    server.delay = args.dmx_delay
+    for name, client_class in (('legacy', LegacyDmxClient), ('current', DmxClient)):
+        client = client_class(server.url)
+        client.start()
+        set_times = []
+        t_end = time.perf_counter() + 1
+        i = 0
+        while time.perf_counter() < t_end:
+            t0 = time.perf_counter()
+            client[1] = i % 256
+            set_times.append(time.perf_counter() - t0)
+            i += 1
+            time.sleep(0.001)
+        client.stop()
+        logger.info("dmx %s: channel write latency with %gms server delay %s" % (
+            name, 1e3 * args.dmx_delay, format_ms(set_times)))
+
+    server.delay = 0
+    client = DmxClient(server.url)
+    client.start()
+    t_end = time.perf_counter() + 2
+    i = 0
+    while time.perf_counter() < t_end:
+        client[1] = i % 256
+        i += 1
+        time.sleep(0.001)
+    stats = client.stats()
+    client.stop()
+    intervals = [b - a for a, b in zip(client._send_starts, list(client._send_starts)[1:])]
+    logger.info("dmx cadence: %d fps (target %d), %d dropped, frame interval %s" % (
+        stats['fps'], client.frame_rate, stats['frames_dropped'], format_ms(intervals)))
+    record('dmx.fps', stats['fps'], 'fps', True)
+    server.stop()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_control_loop(client, duration=2):
+    client.start()
+    time.sleep(0.5)
+    lateness = []
+    set_times = []
+    t_end = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        for channel in range(1, 33):
+            client[channel] = (i + channel) % 256
+        set_times.append(time.perf_counter() - t0)
+        i += 1
+        t0 = time.perf_counter()
+        time.sleep(0.001)
+        lateness.append(time.perf_counter() - t0 - 0.001)
+    stats = client.stats()
+    client.stop()
+    return lateness, set_times, stats
+
+
+def bench_dmxprocess(args):
+    # Control loop wakeup jitter and channel write cost with the DMX sender on a thread or in its own process
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dmxserver.py'),
+                               str(port), '--delay', str(args.dmx_delay)])
+    url = 'http://127.0.0.1:%d' % port
+    try:
+        t_end = time.perf_counter() + 5
+        while True:
+            try:
+                requests.get(url + '/status', timeout=1)
+                break
+            except requests.RequestException:
+                if time.perf_counter() > t_end:
+                    raise
+                time.sleep(0.05)
+        for name, client_class in (('thread', DmxClient), ('process', ProcessDmxClient)):
+            client = client_class(url, encoding='hex')
+            lateness, set_times, stats = time_control_loop(client)
+            if client_class is ProcessDmxClient:
+                client.close()
+            logger.info("dmxprocess %s: wakeup lateness %s, 32 channel writes %s, %d fps" % (
+                name, format_ms(lateness), format_ms(set_times), stats['fps']))
+            check('dmxprocess.%s' % name, stats['frames_sent'] > 0 and stats['send_failures'] == 0,
+                  "%d frames sent, %d send failures" % (stats['frames_sent'], stats['send_failures']))
+        record('dmxprocess.lateness_p99', 1e3 * percentiles(lateness)[2], 'ms')
+        record('dmxprocess.write_p99', 1e3 * percentiles(set_times)[2], 'ms')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_universes(servers, workers, duration=2):
+    manager = UniverseManager({u: server.url for u, server in enumerate(servers)}, encoding='delta', workers=workers)
+    manager.start()
+    t0 = time.perf_counter()
+    t_end = t0 + duration
+    i = 0
+    while time.perf_counter() < t_end:
+        for u in range(len(servers)):
+            manager[u, 1] = i % 256
+        i += 1
+        time.sleep(0.001)
+    fps = [client.frames_sent / (time.perf_counter() - t0) for client in manager.universes.values()]
+    time.sleep(0.2)
+    manager.stop()
+    synced = all(server.dmx[1] == manager[u, 1] for u, server in enumerate(servers))
+    return fps, synced
+
+
+def bench_universes(args):
+    # Frame rate per universe with one stand-in server slowed down, sharing a single sender or a worker pool
+    delay = max(args.dmx_delay, 0.05)
+    servers = [DmxServer().start() for _ in range(4)]
+    servers[0].delay = delay
+    for workers in (1, len(servers)):
+        fps, synced = run_universes(servers, workers)
+        logger.info("universes %d workers, %gms delay on universe 0: fps %s, %s" % (
+            workers, 1e3 * delay, ' '.join('%.0f' % f for f in fps), 'in sync' if synced else 'OUT OF SYNC'))
+        check('universes.%d' % workers, synced, "servers do not hold the last values written")
+    record('universes.slow_fps', fps[0], 'fps', True)
+    record('universes.fast_fps', min(fps[1:]), 'fps', True)
+    for server in servers:
+        server.stop()
+
+
+def bench_cue(args):
+    # Applying and crossfading looks of n channels, per channel through DmxClient versus as cue engine scenes
+    for n in (16, 128, 512):
+        client = DmxClient('http://localhost')
+        looks = [{channel: (channel * 7 + i * 50) % 256 for channel in range(n)} for i in range(2)]
+        t0 = time.perf_counter()
+        for i in range(200):
+            for channel, value in looks[i % 2].items():
+                client[channel] = value
+        t_legacy = (time.perf_counter() - t0) / 200
+        t0 = time.perf_counter()
+        for i in range(200):
+            x = i / 200
+            for channel in range(n):
+                client[channel] = looks[0][channel] + (looks[1][channel] - looks[0][channel]) * x
+        t_legacy_fade = (time.perf_counter() - t0) / 200
+
+        scheduler = Scheduler()
+        cues = CueEngine(client, scheduler)
+        for i, look in enumerate(looks):
+            cues.add_scene(i, look)
+        t0 = time.perf_counter()
+        for i in range(200):
+            cues.go(i % 2)
+        t_go = (time.perf_counter() - t0) / 200
+        cues.go(0, fade=1)
+        t0 = time.perf_counter()
+        for i in range(200):
+            cues._step()
+        t_fade = (time.perf_counter() - t0) / 200
+        cues.stop()
+        logger.info("cue %d channels: per channel %.1f us/look %.1f us/fade frame, scenes %.1f us/look %.1f us/fade frame" % (
+            n, 1e6 * t_legacy, 1e6 * t_legacy_fade, 1e6 * t_go, 1e6 * t_fade))
+        record('cue.%d.go' % n, 1e6 * t_go, 'us')
+        record('cue.%d.fade' % n, 1e6 * t_fade, 'us/frame')
+
+
+def legacy_blinker_update(blinker):
+    if blinker._next_change is None:
+        return
+    if datetime.datetime.utcnow() >= blinker._next_change:
+        blinker._next_change += blinker._period
+
+
+class LegacyBlinker(object):
+    def __init__(self, period):
+        self._period = datetime.timedelta(seconds=period)
+        self._next_change = datetime.datetime.utcnow() + self._period
+
+
+def bench_blink(args):
+    for n in (10, 100, 1000):
+        legacy = [LegacyBlinker(1) for _ in range(n)]
+        t0 = time.perf_counter()
+        for _ in range(1000):
+            for blinker in legacy:
+                legacy_blinker_update(blinker)
+        t_legacy = (time.perf_counter() - t0) / 1000
+
+        scheduler = Scheduler()
+        for _ in range(n):
+            Blinker((lambda: None, lambda: None), 1, scheduler).blink(0.5)
+        t0 = time.perf_counter()
+        for _ in range(1000):
+            scheduler.timeout()
+            scheduler.run_pending()
+        t_current = (time.perf_counter() - t0) / 1000
+        logger.info("blink %d blinkers: legacy %.1f us/tick, scheduler %.1f us/tick" % (
+            n, 1e6 * t_legacy, 1e6 * t_current))
+        record('blink.%d' % n, 1e6 * t_current, 'us/tick')
+
+
+def bench_animation(args):
+    for fixtures in (1, 10, 50):
+        client = DmxClient('http://localhost')
+        scrollers = []
+        for f in range(fixtures):
+            scrollers.append((10 * f + 1, 10 * f + 3, 10 * f + 8,
+                              Scroller(0, 540), Scroller(0, 180), Scroller(0, 255, 255 / 3.0)))
+            for scroller in scrollers[-1][3:]:
+                scroller.scroll_up()
+        t0 = time.perf_counter()
+        for _ in range(200):
+            for pan_channel, tilt_channel, dimmer_channel, pan, tilt, dimmer in scrollers:
+                client.set16(pan_channel, pan.value / 540)
+                client.set16(tilt_channel, tilt.value / 180)
+                client[dimmer_channel] = dimmer.value
+        t_legacy = (time.perf_counter() - t0) / 200
+
+        scheduler = Scheduler()
+        engine = AnimationEngine(client, scheduler)
+        for f in range(fixtures):
+            for channel in (engine.add_channel(10 * f + 1, 0, 540, bits=16),
+                            engine.add_channel(10 * f + 3, 0, 180, bits=16),
+                            engine.add_channel(10 * f + 8, 0, 255, speed=255 / 3.0)):
+                channel.scroll_up()
+        t0 = time.perf_counter()
+        for _ in range(200):
+            engine.write()
+        t_current = (time.perf_counter() - t0) / 200
+        logger.info("animation %d fixtures: scrollers %.1f us/frame, engine %.1f us/frame" % (
+            fixtures, 1e6 * t_legacy, 1e6 * t_current))
+        record('animation.%d' % fixtures, 1e6 * t_current, 'us/frame')
+
+
+def run_simulators(conn, n, events, interval):
+    # Runs in a child process so that simulator CPU is not charged to the hub
+    sims = [PanelSimulator(PanelA) for _ in range(n)]
+    conn.send([sim.port for sim in sims])
+    conn.recv()
+    switch = sorted(PanelA.SWITCHES)[0]
+    sent = [[] for _ in sims]
+    for i in range(events):
+        for sim, times in zip(sims, sent):
+            times.append(time.monotonic())
+            sim.set_switch(switch, i % 2 == 0)
+        time.sleep(interval)
+    conn.send(sent)
+    conn.recv()
+    for sim in sims:
+        sim.close()
+
+
+def time_panels(n, use_hub, events=100, interval=0.01):
+    conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=run_simulators, args=(child_conn, n, events, interval))
+    proc.start()
+    ports = conn.recv()
+    received = {}
+    panel_hub = PanelHub() if use_hub else None
+    panel_list = []
+    for port in ports:
+        panel = PanelA(port, hub=panel_hub)
+        times = received[panel] = []
+        panel.subscribe(lambda change, times=times: times.append(change.timestamp))
+        panel_list.append(panel)
+    for times in received.values():
+        del times[:]
+
+    cpu0 = time.process_time()
+    conn.send(None)
+    sent = conn.recv()
+    t_end = time.monotonic() + 1
+    while any(len(received[p]) < events for p in panel_list) and time.monotonic() < t_end:
+        time.sleep(0.01)
+    cpu = time.process_time() - cpu0
+    if panel_hub is not None:
+        panel_hub.close()
+    else:
+        for panel in panel_list:
+            panel.close()
+    # Listener threads report the closed simulator ports as errors
+    level = panels.logger.level
+    panels.logger.setLevel(logging.CRITICAL)
+    conn.send(None)
+    proc.join()
+    time.sleep(0.1)
+    panels.logger.setLevel(level)
+
+    latencies = []
+    for panel, times in zip(panel_list, sent):
+        latencies.extend(r - s for s, r in zip(times, received[panel]))
+    return cpu / (n * events), latencies
+
+
+def bench_hub(args):
+    for n in (1, 4, 16, 32):
+        for name, use_hub in (('threads', False), ('hub', True)):
+            cpu, latencies = time_panels(n, use_hub)
+            logger.info("hub %2d panels %s: %.1f us CPU/event, latency %s" % (
+                n, name, 1e6 * cpu, format_ms(latencies)))
+        record('hub.%d.cpu' % n, 1e6 * cpu, 'us/event')
+        record('hub.%d.latency_p90' % n, 1e3 * percentiles(latencies)[1], 'ms')
+
+
+def close_simulated(panel, sim):
+    panel.close()
+    sim.close()
+
+
+def time_startup(layout, repeat=5):
+    times = []
+    for _ in range(repeat):
+        sim = PanelSimulator(layout)
+        t0 = time.perf_counter()
+        panel = layout(sim.port)
+        times.append(time.perf_counter() - t0)
+        close_simulated(panel, sim)
+    return times
+
+
+def time_storm(layout, count):
+    sim = PanelSimulator(layout)
+    panel = layout(sim.port)
+    t0 = time.perf_counter()
+    sent = sim.storm(count, analog_fraction=0.5 if layout.ANALOGS else 0)
+    # Repeated analog samples are not changes, so wait for a reply queued behind the whole storm
+    panel.wait_ready()
+    dt = time.perf_counter() - t0
+    close_simulated(panel, sim)
+    return sent / dt
+
+
+def time_queries(layout, count):
+    sim = PanelSimulator(layout)
+    panel = layout(sim.port)
+    switch = sorted(layout.SWITCHES)[0]
+    times = []
+    for _ in range(count):
+        t0 = time.perf_counter()
+        panel.read_switch(switch)
+        times.append(time.perf_counter() - t0)
+    close_simulated(panel, sim)
+    return times
+
+
+def time_commands(layout, count):
+    sim = PanelSimulator(layout)
+    panel = layout(sim.port)
+    indicator = sorted(layout.BINARY_INDICATORS)[0]
+    expected = sim.commands + count
+    t0 = time.perf_counter()
+    for i in range(count):
+        panel.set_indicator(indicator, i % 2 == 0)
+    while sim.commands < expected and time.perf_counter() - t0 < 5:
+        time.sleep(0.0005)
+    dt = time.perf_counter() - t0
+    close_simulated(panel, sim)
+    return count / dt
+
+
+def bench_protocol(args):
+    # Panel startup, event throughput, query round trips and command writes against simulated firmware
+    count = min(args.messages, 20000)
+    for name, layout in (('PanelA', PanelA), ('PanelB', PanelB)):
+        startup = time_startup(layout)
+        events = time_storm(layout, count)
+        queries = time_queries(layout, 500)
+        commands = time_commands(layout, count)
+        logger.info("protocol %s: startup %s, %.0f events/s, query round trip %s, %.0f commands/s" % (
+            name, format_ms(startup), events, format_ms(queries), commands))
+        record('protocol.%s.startup_p50' % name, 1e3 * percentiles(startup)[0], 'ms')
+        record('protocol.%s.events' % name, events, 'events/s', True)
+        record('protocol.%s.query_p50' % name, 1e3 * percentiles(queries)[0], 'ms')
+        record('protocol.%s.commands' % name, commands, 'commands/s', True)
+
+
+def slider_curve(x):
+    v = 0.000770032 * math.exp(0.00628978 * x) - 0.00127362
+    return min(max(v, 0), 1)
+
+
+def bench_analog(args):
+    sim = PanelSimulator(PanelA)
+    panel = PanelA(sim.port)
+    panel.set_analog_push('0')
+    panel.wait_ready()
+    rnd = random.Random(0)
+    jitter = [600 + rnd.randint(-2, 2) for _ in range(2000)]
+    for name, kwargs in (('raw', {}), ('filtered', {'smoothing': 'median', 'deadband': 3})):
+        panel.configure_analog('0', calibration=slider_curve, **kwargs)
+        panel.changed_analogs()
+        changes = []
+        panel.subscribe(changes.append)
+        for v in jitter:
+            sim.set_analog('0', v)
+        panel.wait_ready()
+        # Keep counting the changes a settling filter reports once the input goes quiet
+        time.sleep(2 * panels.AnalogFilter.SETTLE)
+        panel.unsubscribe(changes.append)
+        logger.info("analog %s: %d change events from %d jittering samples" % (name, len(changes), len(jitter)))
+        record('analog.%s.changes' % name, len(changes), 'events')
+
+    # The simulator encodes readings the way the firmware does, so this shows where the host decodes them differently
+    panel.configure_analog('0', calibration=slider_curve)
+    mismatches = []
+    for v in (0, 31, 32, 600, 1023):
+        sim.set_analog('0', v)
+        panel.wait_ready()
+        got = panel.get_analog('0')
+        if got != v:
+            mismatches.append('%d read as %s' % (v, got))
+    if mismatches:
+        logger.warning("analog readback: firmware and host encodings differ (%s)" % ', '.join(mismatches))
+    record('analog.readback_mismatches', len(mismatches), 'values')
+
+    read_times = []
+    for _ in range(500):
+        t0 = time.perf_counter()
+        slider_curve(panel.read_analog('0'))
+        read_times.append(time.perf_counter() - t0)
+    cached_times = []
+    for _ in range(500):
+        t0 = time.perf_counter()
+        panel.get_calibrated('0')
+        cached_times.append(time.perf_counter() - t0)
+    logger.info("analog slider read: query and curve %.1f us, cached lookup %.1f us (p50)" % (
+        1e6 * percentiles(read_times)[0], 1e6 * percentiles(cached_times)[0]))
+    record('analog.cached_read_p50', 1e6 * percentiles(cached_times)[0], 'us')
+    close_simulated(panel, sim)
+
+
+# Typical time an Arduino spends in its bootloader after the host opens the port
+BOOT_DELAY = 1.6
+STARTUP_CHILD = '''
+import sys, time
+t0 = time.perf_counter()
+import PanelBLightController as launcher
+t_import = time.perf_counter() - t0
+panel = launcher.PANEL(sys.argv[1], autoflush=False, state_file=sys.argv[2] or None)
+system = launcher.create_system(panel)
+t_loop = time.perf_counter() - t0
+while True:
+    changed = panel.changed_switches(timeout=5)
+    for switch in changed:
+        system.switch_changed(switch, panel.get_switch(switch))
+    if sys.argv[3] in changed:
+        break
+print('%f %f %f' % (t_import, t_loop, time.perf_counter() - t0), flush=True)
+'''
+
+
+def time_first_event(state_file, boot_delay):
+    sim = PanelSimulator(PanelB, boot_delay=boot_delay)
+    switch = sorted(PanelB.SWITCHES)[0]
+    # Flipped while the application restarts, so it has to be picked up by initialization or reconciliation
+    sim.switches[switch] = True
+    t0 = time.perf_counter()
+    child = subprocess.run([sys.executable, '-c', STARTUP_CHILD, sim.port, state_file or '', switch],
+                           cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                           timeout=30)
+    t_event = time.perf_counter() - t0
+    sim.close()
+    t_import, t_loop, t_handled = (float(x) for x in child.stdout.split())
+    return t_import, t_loop, t_event
+
+
+def bench_startup(args):
+    # Time from launching PanelBLightController to handling a switch flipped during the restart
+    state_file = os.path.join(tempfile.mkdtemp(), 'PanelB.json')
+    sim = PanelSimulator(PanelB)
+    panel = PanelB(sim.port)
+    panel.save_state(state_file)
+    close_simulated(panel, sim)
+    for boot_delay in (0, BOOT_DELAY):
+        for name, path in (('cold', None), ('saved state', state_file)):
+            runs = [time_first_event(path, boot_delay) for _ in range(3)]
+            t_import, t_loop, t_event = (percentiles(samples)[0] for samples in zip(*runs))
+            logger.info("startup %s, %gs board boot: imports %.1f ms, control loop running after %.1f ms, "
+                        "first event handled after %.1f ms" % (
+                            name, boot_delay, 1e3 * t_import, 1e3 * t_loop, 1e3 * t_event))
+    record('startup.loop', 1e3 * t_loop, 'ms')
+    record('startup.first_event', 1e3 * t_event, 'ms')
+
+
+def bench_store(args):
+    ser = FakeSerial()
+    panel = PanelA(ser)
+    switches = sorted(PanelA.SWITCHES)
+    n = args.messages
+
+    lock = threading.Lock()
+    values = {PanelA.SWITCH_PREFIX + s: False for s in switches}
+
+    def legacy_get_switch(switch):
+        with lock:
+            return values[PanelA.SWITCH_PREFIX + switch]
+
+    reads = [switches[i % len(switches)] for i in range(n)]
+    t0 = time.perf_counter()
+    for switch in reads:
+        legacy_get_switch(switch)
+    t_legacy = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for switch in reads:
+        panel.get_switch(switch)
+    t_current = time.perf_counter() - t0
+
+    before = panel.snapshot()
+    ser.feed(b'SB0D\nA0ZZ\n')
+    panel.wait_ready()
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        changed = panel.diff(before)
+    t_diff = (time.perf_counter() - t0) / 1000
+    panel.close()
+    logger.info("store get_switch: dict and lock %.3f us, slots %.3f us (%.1fx); snapshot diff %.1f us %s" % (
+        1e6 * t_legacy / n, 1e6 * t_current / n, t_legacy / t_current, 1e6 * t_diff, changed))
+    record('store.get_switch', 1e6 * t_current / n, 'us')
+    record('store.diff', 1e6 * t_diff, 'us')
+
+
+def time_servo_latency(queue_size, duration=2):
+    sim = PanelSimulator(PanelA, baudrate=PanelA.BAUDRATE)
+    panel = PanelA(sim.port, queue_size=queue_size)
+    stopping = threading.Event()
+    indicator_times = []
+
+    def animate():
+        leds = sorted(PanelA.COLORED_LEDS)
+        i = 0
+        while not stopping.is_set():
+            for n, led in enumerate(leds):
+                t0 = time.perf_counter()
+                panel.set_indicator(led, (i + n) % 8)
+                indicator_times.append(time.perf_counter() - t0)
+            i += 1
+            time.sleep(0.0005)
+
+    t = threading.Thread(target=animate)
+    t.start()
+    latencies = []
+    value = 20
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        value = 20 + (value + 37) % 140
+        t0 = time.perf_counter()
+        panel.set_servo('0', value)
+        while sim.servos.get('0') != value and time.perf_counter() - t0 < 5:
+            time.sleep(0.0002)
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(0.02)
+    stopping.set()
+    t.join()
+    close_simulated(panel, sim)
+    return latencies, indicator_times
+
+
+def bench_queue(args):
+    # Servo command latency on a 115200 baud link while an LED animation floods it, written
+    # directly or through the priority queue
+    for name, queue_size in (('direct', None), ('queued', 64)):
+        latencies, indicator_times = time_servo_latency(queue_size)
+        logger.info("queue %s: servo latency %s, LED update call %s" % (
+            name, format_ms(latencies), format_ms(indicator_times)))
+    record('queue.servo_p99', 1e3 * percentiles(latencies)[2], 'ms')
+    record('queue.indicator_p99', 1e3 * percentiles(indicator_times)[2], 'ms')
+
+
+def bench_reconnect(args):
+    # Kills the simulated board's pty and recreates it after an outage, timing how long the panel
+    # takes to notice, reopen the port, reapply its outputs and resynchronize its inputs
+    link = os.path.join(tempfile.mkdtemp(), 'ttyPanelA')
+    sim = PanelSimulator(PanelA, link=link)
+    panel = PanelA(link, heartbeat=0.5)
+    level = panels.logger.level
+    panels.logger.setLevel(logging.CRITICAL)
+    for outage in (0.1, 1.0, 3.0):
+        panel.set_indicator('Q0', 5)
+        panel.set_servo('0', 99)
+        t0 = time.perf_counter()
+        sim.close()
+        while panel.connected and time.perf_counter() - t0 < 5:
+            time.sleep(0.0005)
+        t_detect = time.perf_counter() - t0
+        time.sleep(max(0, outage - t_detect))
+        sim = PanelSimulator(PanelA, link=link)
+        sim.switches['S0'] = not panel.get_switch('S0')
+        t1 = time.perf_counter()
+        reconnects = panel.reconnects
+        while panel.reconnects == reconnects and time.perf_counter() - t1 < 30:
+            time.sleep(0.0005)
+        panel.reconciled.result(10)
+        t_recover = time.perf_counter() - t1
+        restored = sim.indicators.get('Q0') == '5' and sim.servos.get('0') == 99
+        synced = panel.get_switch('S0') == sim.switches['S0']
+        logger.info("reconnect after %gs outage: detected in %.1f ms, recovered %.1f ms after the device returned "
+                    "(%.1f ms total), outputs %s, inputs %s" % (
+                        outage, 1e3 * t_detect, 1e3 * t_recover, 1e3 * (time.perf_counter() - t0),
+                        'restored' if restored else 'NOT RESTORED', 'in sync' if synced else 'OUT OF SYNC'))
+        check('reconnect.%g' % outage, restored and synced, "outputs %s, inputs %s after reconnecting" % (
+            'restored' if restored else 'not restored', 'in sync' if synced else 'out of sync'))
+        record('reconnect.%g.detect' % outage, 1e3 * t_detect, 'ms')
+        record('reconnect.%g.recover' % outage, 1e3 * t_recover, 'ms')
+    close_simulated(panel, sim)
+    panels.logger.setLevel(level)
+
+
+def bench_record(args):
+    path = os.path.join(tempfile.mkdtemp(), 'panel.rec')
+    msgs = make_messages(PanelA, args.messages)
+    recorder = Recorder(path)
+    t_plain = t_recorded = float('inf')
+    for _ in range(5):
+        t_plain = min(t_plain, time_listen(PanelA, msgs))
+        t_recorded = min(t_recorded, time_listen(PanelA, msgs, recorder))
+
+    frame = bytearray(dmx.CHANNELS)
+    t0 = time.perf_counter()
+    for i in range(args.frames):
+        frame[i % 64] = i % 256
+        recorder.record_frame(frame)
+    t_frame = (time.perf_counter() - t0) / args.frames
+    recorder.close()
+    size = sum(os.path.getsize(f) for f in recording_files(path))
+    logger.info("record listen: %.0f lines/s plain, %.0f lines/s recorded (%.1f%% overhead); "
+                "%.1f us/DMX frame; %d records in %d bytes" % (
+                    len(msgs) / t_plain, len(msgs) / t_recorded, 100 * (t_recorded / t_plain - 1),
+                    1e6 * t_frame, recorder.records, size))
+    record('record.overhead', 100 * (t_recorded / t_plain - 1), '%')
+    for f in recording_files(path):
+        os.remove(f)
+
+    # Frames read back across rotations must match what was recorded, although older files are gone
+    recorder = Recorder(path, size=4096, files=3)
+    rnd = random.Random(0)
+    frames = []
+    for i in range(2000):
+        channel = rnd.randrange(dmx.CHANNELS)
+        frame[channel] = (frame[channel] + rnd.randrange(1, 256)) % 256
+        recorder.record_frame(frame)
+        frames.append(bytes(frame))
+    recorder.close()
+    replayed = [f for t, f in read_frames(path)]
+    ok = len(replayed) > 0 and replayed == frames[-len(replayed):]
+    logger.info("record round trip: %d of %d frames kept in %d files, %s" % (
+        len(replayed), len(frames), len(recording_files(path)), 'match' if ok else 'MISMATCH'))
+    check('record.round_trip', ok, "frames read back differ from the frames recorded")
+    for f in recording_files(path):
+        os.remove(f)
+
+    # A session recorded with the launcher's heartbeat on replays through a heartbeat-less panel
+    # without stalling on the recorded *RID queries
+    level = panels.logger.level
+    panels.logger.setLevel(logging.CRITICAL)
+    sim = PanelSimulator(PanelA)
+    recorder = Recorder(path)
+    panel = PanelALauncher.PANEL(sim.port, autoflush=False, recorder=recorder, heartbeat=0.05)
+    system = PanelALauncher.create_system(panel)
+    switches = sorted(PanelA.SWITCHES)
+    t_end = time.perf_counter() + 1
+    i = 0
+    while time.perf_counter() < t_end:
+        sim.set_switch(switches[i % len(switches)], i // len(switches) % 2 == 0)
+        PanelALauncher.step(panel, system, 0.01)
+        time.sleep(0.005)
+        i += 1
+    panel.wait_ready()
+    expected = panel.snapshot()
+    close_simulated(panel, sim)
+    recorder.close()
+    t0 = time.perf_counter()
+    replayed, system = replay(path, PanelALauncher, realtime=False)
+    t_replay = time.perf_counter() - t0
+    replayed.close()
+    panels.logger.setLevel(level)
+    same = replayed.snapshot() == expected
+    logger.info("record replay with heartbeat: %d switch changes replayed in %.3fs, inputs %s" % (
+        i, t_replay, 'match' if same else 'DIFFER'))
+    record('record.replay_heartbeat', 1e3 * t_replay, 'ms')
+    check('record.replay_heartbeat', same and t_replay < REPLAY_STALL * i / 10,
+          "replay took %.3fs, inputs %s" % (t_replay, 'match' if same else 'differ'))
+    for f in recording_files(path):
+        os.remove(f)
+
+
+def bench_metrics(args):
+    registry = Registry()
+    msgs = make_messages(PanelA, args.messages)
+    t_plain = t_measured = float('inf')
+    for _ in range(5):
+        t_plain = min(t_plain, time_listen(PanelA, msgs))
+        t_measured = min(t_measured, time_listen(PanelA, msgs, metrics=registry))
+
+    histogram = registry.histogram('benchmark_seconds', 'Benchmark observations')
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        histogram.observe(1e-4)
+    t_observe = (time.perf_counter() - t0) / args.messages
+    logger.info("metrics listen: %.0f lines/s plain, %.0f lines/s instrumented (%.1f%% overhead); "
+                "%.2f us/observation" % (len(msgs) / t_plain, len(msgs) / t_measured,
+                                         100 * (t_measured / t_plain - 1), 1e6 * t_observe))
+    record('metrics.observe', 1e6 * t_observe, 'us')
+
+
+def legacy_indicator_command(panel_class, indicator, value):
+    if indicator in panel_class.BINARY_INDICATORS:
+        cmd = 'S%s%s' % (indicator, '1' if value else '0')
+    else:
+        cmd = 'S%s%s' % (indicator, value)
+    return 'S' + indicator, cmd
+
+
+def legacy_servo_command(panel_class, servo, value):
+    value = round(value)
+    s = panel_class.SERVO_DIGITS[value // panel_class.SERVO_BASE] + panel_class.SERVO_DIGITS[value % panel_class.SERVO_BASE]
+    return 'T' + servo, 'T%s%s' % (servo, s)
+
+
+def bench_encode(args):
+    n = args.messages
+    values = [i % 181 for i in range(n)]
+    for name, servo, indicator in (('legacy', legacy_servo_command, legacy_indicator_command),
+                                   ('compiled', PanelA._servo_command.__func__, PanelA._indicator_command.__func__)):
+        t0 = time.perf_counter()
+        for v in values:
+            servo(PanelA, '0', v)
+        t_servo = (time.perf_counter() - t0) / n
+        t0 = time.perf_counter()
+        for v in values:
+            indicator(PanelA, 'Q0', v & 7)
+        t_indicator = (time.perf_counter() - t0) / n
+        logger.info("encode %s: servo %.3f us, colored indicator %.3f us" % (name, 1e6 * t_servo, 1e6 * t_indicator))
+    record('encode.servo', 1e6 * t_servo, 'us')
+    record('encode.indicator', 1e6 * t_indicator, 'us')
+
+
+def legacy_servo_ramp(panel, servo, start, peak, ramp):
+    for i in range(11):
+        panel.set_servo(servo, i * (peak - start) / 10 + start)
+        time.sleep(ramp / 10)
+
+
+def time_servo_ramp(move, start=20, peak=160, ramp=0.5):
+    sim = PanelSimulator(PanelA)
+    panel = PanelA(sim.port)
+    panel.set_servo('0', start)
+    time.sleep(0.05)
+    commands = sim.commands
+    blocked = []
+
+    def run():
+        t_call = time.perf_counter()
+        move(panel, '0', start, peak, ramp)
+        blocked.append(time.perf_counter() - t_call)
+
+    t0 = time.perf_counter()
+    t = threading.Thread(target=run)
+    t.start()
+    errors = []
+    while time.perf_counter() - t0 < ramp:
+        expected = start + (peak - start) * (time.perf_counter() - t0) / ramp
+        errors.append(abs(sim.servos.get('0', start) - expected))
+        time.sleep(0.001)
+    t.join()
+    while panel.servo_moving('0'):
+        time.sleep(0.001)
+    updates = sim.commands - commands
+    close_simulated(panel, sim)
+    return blocked[0], max(errors), sum(errors) / len(errors), updates
+
+
+def bench_servo(args):
+    # Tracking error of a linear throttle ramp as seen by the firmware, and how long the caller is blocked
+    for name, move in (('legacy', legacy_servo_ramp),
+                       ('profile', lambda panel, servo, start, peak, ramp: panel.move_servo(servo, peak, ramp))):
+        blocked, error_max, error_avg, updates = time_servo_ramp(move)
+        logger.info("servo %s: caller blocked %.3f ms, %d updates, tracking error avg %.1f max %.1f degrees" % (
+            name, 1e3 * blocked, updates, error_avg, error_max))
+    record('servo.blocked', 1e3 * blocked, 'ms')
+    record('servo.tracking_error_max', error_max, 'degrees')
+    record('servo.updates', updates, 'commands', True)
+
+
+async def time_aio(count):
+    sim = PanelSimulator(PanelA)
+    panel = await AsyncPanel.open(PanelA, sim.port)
+    server = DmxServer().start()
+    client = AsyncDmxClient(server.url)
+    client.start()
+    changes = asyncio.Queue()
+    panel.subscribe(changes.put_nowait)
+    times = {'query': [], 'push': [], 'output': [], 'dmx': []}
+    errors = 0
+    for i in range(count):
+        down = i % 2 == 0
+        sim.switches['S0'] = down
+        t0 = time.perf_counter()
+        errors += await panel.read_switch('S0') != down
+        times['query'].append(time.perf_counter() - t0)
+        await asyncio.wait_for(changes.get(), 1)
+
+        t0 = time.perf_counter()
+        sim.set_switch('S1', down)
+        change = await asyncio.wait_for(changes.get(), 1)
+        times['push'].append(time.perf_counter() - t0)
+        errors += change.name != 'S1' or change.value != down
+
+        value = i % 8
+        t0 = time.perf_counter()
+        panel.set_indicator('Q0', value)
+        while sim.indicators.get('Q0') != str(value) and time.perf_counter() - t0 < 1:
+            await asyncio.sleep(0.0001)
+        times['output'].append(time.perf_counter() - t0)
+        errors += sim.indicators.get('Q0') != str(value)
+
+        value = 1 + i % 255
+        t0 = time.perf_counter()
+        client[1] = value
+        while server.dmx[1] != value and time.perf_counter() - t0 < 1:
+            await asyncio.sleep(0.0001)
+        times['dmx'].append(time.perf_counter() - t0)
+        errors += server.dmx[1] != value
+    await asyncio.wait_for(client.stop(), 1)
+    panel.close()
+    sim.close()
+    server.stop()
+    return times, errors
+
+
+async def compare_changes(msgs):
+    # Feeds the same input stream, repeats included, to a Panel and an AsyncPanel
+    sims = [PanelSimulator(PanelA), PanelSimulator(PanelA)]
+    panel = PanelA(sims[0].port)
+    aio_panel = await AsyncPanel.open(PanelA, sims[1].port)
+    changes = [], []
+    panel.subscribe(changes[0].append)
+    aio_panel.subscribe(changes[1].append)
+    for sim in sims:
+        sim.send(msgs)
+    panel.wait_ready()
+    await aio_panel.wait_ready()
+    close_simulated(panel, sims[0])
+    aio_panel.close()
+    sims[1].close()
+    return [[(c.kind, c.name, c.value) for c in cs] for cs in changes]
+
+
+def bench_aio(args):
+    # Query, push, output and DMX send round trips through AsyncPanel and AsyncDmxClient
+    # against the simulated board and an in-process DMX server
+    times, errors = asyncio.run(time_aio(200))
+    for name in ('query', 'push', 'output', 'dmx'):
+        logger.info("aio %s round trip: %s" % (name, format_ms(times[name])))
+        record('aio.%s_p50' % name, 1e3 * percentiles(times[name])[0], 'ms')
+    logger.info("aio: %d wrong values in %d round trips" % (errors, 4 * len(times['query'])))
+    check('aio', errors == 0, "%d wrong values" % errors)
+
+    msgs = make_messages(PanelA, 2000)
+    sync_changes, aio_changes = asyncio.run(compare_changes(msgs))
+    logger.info("aio changes: Panel %d, AsyncPanel %d from %d messages" % (
+        len(sync_changes), len(aio_changes), len(msgs)))
+    check('aio.changes', sync_changes == aio_changes, "Panel and AsyncPanel report different changes")
+
+
+BENCHMARKS = {
+    'aio': bench_aio,
+    'analog': bench_analog,
+    'animation': bench_animation,
+    'blink': bench_blink,
+    'cue': bench_cue,
+    'decode': bench_decode,
+    'dmx': bench_dmx,
+    'dmxprocess': bench_dmxprocess,
+    'encode': bench_encode,
+    'hub': bench_hub,
+    'listen': bench_listen,
+    'metrics': bench_metrics,
+    'protocol': bench_protocol,
+    'queue': bench_queue,
+    'reconnect': bench_reconnect,
+    'record': bench_record,
+    'servo': bench_servo,
+    'startup': bench_startup,
+    'store': bench_store,
+    'universes': bench_universes,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path):
+    saved = {'time': datetime.datetime.now().isoformat(),
+             'revision': git_revision(),
+             'python': sys.version.split()[0],
+             'machine': platform.node(),
+             'results': RESULTS}
+    with open(path, 'w') as f:
+        json.dump(saved, f, indent=2, sort_keys=True)
+    logger.info("Saved %d results to %s" % (len(RESULTS), path))
+
+
+def compare_results(path, threshold):
+    with open(path) as f:
+        saved = json.load(f)
+    logger.info("Comparing against %s (revision %s)" % (path, saved.get('revision')))
+    regressions = 0
+    for name in sorted(RESULTS):
+        if name not in saved['results']:
+            continue
+        old = saved['results'][name]['value']
+        result = RESULTS[name]
+        if not old:
+            continue
+        change = result['value'] / old - 1
+        if result['higher_is_better']:
+            change = -change
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        logger.info("  %-30s %10.3g -> %10.3g %s%s" % (name, old, result['value'], result['unit'], flag))
+    logger.info("%d regression(s) beyond %g%%" % (regressions, 100 * threshold))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Panel and DMX performance benchmarks')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='Benchmarks to run (default: all): ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--messages', type=int, default=100000, help='Number of messages per run')
+    parser.add_argument('--frames', type=int, default=500, help='Number of DMX frames per run')
+    parser.add_argument('--dmx-delay', type=float, default=0.01, help='Stand-in DMX server response delay')
+    parser.add_argument('--save', metavar='FILE', help='Save results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='Compare results against a JSON file saved earlier, exiting non-zero on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change reported as a regression by --compare')
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmark(s): ' + ', '.join(sorted(unknown)))
+
+    panels.logger.setLevel(logging.WARNING)
+    hub.logger.setLevel(logging.WARNING)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+    regressions = 0
+    if args.compare:
+        regressions = compare_results(args.compare, args.threshold)
+    if args.save:
+        save_results(args.save)
+    if FAILURES:
+        logger.error("%d check(s) failed: %s" % (len(FAILURES), ', '.join(FAILURES)))
+    if FAILURES or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
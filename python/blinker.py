@@ -1,28 +1,36 @@
-import datetime
+from scheduler import default_scheduler
 
 
 class Blinker(object):
-    def __init__(self, actions, stop_action):
+    def __init__(self, actions, stop_action, scheduler=None):
         self._actions = actions
         self._stop_action = stop_action
+        self._scheduler = default_scheduler if scheduler is None else scheduler
         self._next_action = 0
-        self._next_change = None
+        self._timer = None
         self._period = None
 
     def blink(self, frequency):
-        self._period = datetime.timedelta(seconds=1 / frequency / len(self._actions))
-        if self._next_change is None or self._next_change > datetime.datetime.utcnow() + self._period:
-            self._next_change = datetime.datetime.utcnow() + self._period
+        self._period = 1 / frequency / len(self._actions)
+        next_change = self._scheduler.clock() + self._period
+        if self._timer is None or self._timer.due > next_change:
+            self._scheduler.cancel(self._timer)
+            self._timer = self._scheduler.call_at(next_change, self._change)
 
     def stop(self):
-        if self._next_change is not None:
-            self._next_change = None
+        if self._timer is not None:
+            self._scheduler.cancel(self._timer)
+            self._timer = None
             self._actions[self._stop_action]()
 
     def update(self):
-        if self._next_change is None:
-            return
-        if datetime.datetime.utcnow() >= self._next_change:
-            self._actions[self._next_action]()
-            self._next_action = (self._next_action + 1) % len(self._actions)
-            self._next_change += self._period
+        self._scheduler.run_pending()
+
+    def _change(self):
+        self._actions[self._next_action]()
+        self._next_action = (self._next_action + 1) % len(self._actions)
+        next_change = self._timer.due + self._period
+        now = self._scheduler.clock()
+        if next_change < now:
+            next_change = now + self._period
+        self._timer = self._scheduler.call_at(next_change, self._change)
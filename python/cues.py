@@ -0,0 +1,88 @@
+import numpy as np
+from dmx import CHANNELS
+from scheduler import default_scheduler
+
+
+class Scene(object):
+    __slots__ = ('name', 'channels', 'values')
+
+    def __init__(self, name, channels, values):
+        self.name = name
+        self.channels = channels
+        self.values = values
+
+
+# Named looks stored as precomputed channel values, applied to a DmxClient universe in one
+# buffer operation and crossfaded by interpolating every channel of the scene at once.
+# A scene only owns the channels it was defined with, so animated channels keep moving.
+class CueEngine(object):
+    def __init__(self, dmx, scheduler=None, frame_rate=None):
+        self.dmx = dmx
+        self.scenes = {}
+        self.scene = None
+        self._scheduler = default_scheduler if scheduler is None else scheduler
+        self._interval = 1.0 / (dmx.frame_rate if frame_rate is None else frame_rate)
+        self._timer = None
+        self._fade = None
+
+    def add_scene(self, name, values):
+        if isinstance(values, dict):
+            channels = np.fromiter(values.keys(), dtype=np.intp, count=len(values))
+            levels = np.fromiter(values.values(), dtype=float, count=len(values))
+        else:
+            levels = np.asarray(values, dtype=float)
+            if levels.shape != (CHANNELS,):
+                raise ValueError("Scene '%s' has %d channel values instead of %d" % (name, levels.size, CHANNELS))
+            channels = np.arange(CHANNELS, dtype=np.intp)
+        if channels.size and (channels.min() < 0 or channels.max() >= CHANNELS):
+            raise ValueError("Scene '%s' has DMX channels outside the range [0, %d)" % (name, CHANNELS))
+        scene = Scene(name, channels, np.rint(np.clip(levels, 0, 255)).astype(np.uint8))
+        self.scenes[name] = scene
+        return scene
+
+    def capture(self, name, channels=None):
+        frame = np.frombuffer(self.dmx[:], dtype=np.uint8)
+        if channels is None:
+            return self.add_scene(name, frame)
+        return self.add_scene(name, {channel: frame[channel] for channel in channels})
+
+    def remove_scene(self, name):
+        if self.scenes.pop(name, None) is None:
+            raise ValueError("Scene '%s' does not exist" % (name,))
+
+    def go(self, name, fade=0):
+        scene = self.scenes.get(name)
+        if scene is None:
+            raise ValueError("Scene '%s' does not exist" % (name,))
+        self.stop()
+        self.scene = name
+        if fade <= 0:
+            self._write(scene.channels, scene.values)
+            return
+        start = np.frombuffer(self.dmx[:], dtype=np.uint8)[scene.channels].astype(float)
+        self._fade = (scene, start, scene.values - start, self._scheduler.clock(), fade)
+        self._step()
+
+    def fading(self):
+        return self._fade is not None
+
+    def stop(self):
+        self._scheduler.cancel(self._timer)
+        self._timer = None
+        self._fade = None
+
+    def _step(self):
+        scene, start, delta, t0, duration = self._fade
+        x = min(1.0, (self._scheduler.clock() - t0) / duration)
+        self._write(scene.channels, np.rint(start + delta * x).astype(np.uint8))
+        if x < 1:
+            self._timer = self._scheduler.call_later(self._interval, self._step)
+        else:
+            self._timer = None
+            self._fade = None
+
+    def _write(self, channels, values):
+        with self.dmx.edit() as universe:
+            buf = np.frombuffer(universe, dtype=np.uint8)
+            buf[channels] = values
+            del buf
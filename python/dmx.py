@@ -1,8 +1,11 @@
+import collections
+import contextlib
+import importlib
 import logging
 import os
+import struct
 import threading
 import time
-import requests
 
 
 logger = logging.getLogger(__name__)
@@ -10,20 +13,125 @@ logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 
+CHANNELS = 512
+ENCODINGS = ('hex', 'binary', 'delta')
+SPAN_HEADER = struct.Struct('>HH')
+SPAN_MERGE_GAP = SPAN_HEADER.size
+SEND_TIMEOUT = 0.5
+FRAME_RATE = 44
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 5
+
+# requests is imported by the first frame send rather than at application startup
+requests = None
+
+
+def load_requests():
+    global requests
+    if requests is None:
+        requests = importlib.import_module('requests')
+    return requests
+
+
+def to_byte(value):
+    if isinstance(value, float):
+        value = int(round(value))
+    if value < 0:
+        return 0
+    if value > 255:
+        return 255
+    return value
+
+
+def changed_spans(old, new):
+    spans = []
+    start = None
+    last = None
+    for i, (a, b) in enumerate(zip(old, new)):
+        if a != b:
+            if start is None:
+                start = i
+            elif i - last > SPAN_MERGE_GAP:
+                spans.append((start, last + 1))
+                start = i
+            last = i
+    if start is not None:
+        spans.append((start, last + 1))
+    return spans
+
+
+def encode_spans(frame, spans):
+    return b''.join(SPAN_HEADER.pack(i0, i1 - i0) + frame[i0:i1] for i0, i1 in spans)
+
+
+# Frames go out on a grid of `period` seconds. A frame wanted after more than a period of idling is
+# sent right away and restarts the grid from there.
+def frame_start(next_frame, period, now):
+    return now if now - next_frame >= period else next_frame
+
+
+# Advances the grid past a frame sent at `next_frame`; returns the next frame time and how many
+# slots were missed because the send ran late
+def next_frame_time(next_frame, period, now):
+    next_frame += period
+    missed = 0
+    if now > next_frame:
+        missed = int((now - next_frame) / period) + 1
+        next_frame += missed * period
+    return next_frame, missed
+
+
 class DmxClient(object):
-    def __init__(self, base_url):
+    def __init__(self, base_url, encoding='hex', timeout=SEND_TIMEOUT, frame_rate=FRAME_RATE, recorder=None,
+                 metrics=None):
+        if encoding not in ENCODINGS:
+            raise ValueError("DMX encoding '%s' is not one of %s" % (encoding, ', '.join(ENCODINGS)))
         self.base_url = base_url
-        self._dmx = bytearray(''.join(['00'] * 512), 'ascii')
-        self._dirty = True
+        self.encoding = encoding
+        self.timeout = timeout
+        self.frame_rate = frame_rate
+        self.recorder = recorder
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.send_failures = 0
+        self.send_time_total = 0
+        self.send_time_max = 0
+        self._send_starts = collections.deque(maxlen=4 * frame_rate)
+        self._session = None
+        self._backoff = 0
+        self._retry_at = 0
+        self._dmx = bytearray(CHANNELS)
+        self._sent = None
+        self._dirty = threading.Event()
+        self._dirty.set()
         self._lock = threading.RLock()
         self._active = False
+        self._stopping = threading.Event()
         self._complete = threading.Event()
+        self._dirty_since = None
+        self._frame_dirty_since = None
+        self._on_dirty = None
+        self.metrics = metrics
+        if metrics is not None:
+            labels = {'url': base_url}
+            self._send_time = metrics.histogram('dmx_send_seconds', 'DMX frame send latency', labels)
+            self._dirty_time = metrics.histogram(
+                'dmx_dirty_to_sent_seconds', 'Delay from the first channel change to the frame being sent', labels)
+            self._lock_time = metrics.histogram(
+                'dmx_lock_wait_seconds', 'Time the sender waits for the universe lock', labels)
+            metrics.gauge('dmx_frames_per_second', 'DMX frames sent in the last second',
+                          lambda: self.stats()['fps'], labels)
+            metrics.counter('dmx_frames_sent_total', 'DMX frames sent', lambda: self.frames_sent, labels)
+            metrics.counter('dmx_frames_dropped_total', 'DMX frame slots missed while dirty',
+                            lambda: self.frames_dropped, labels)
+            metrics.counter('dmx_send_failures_total', 'Failed DMX frame sends', lambda: self.send_failures, labels)
 
     def start(self):
         if self._active:
             return
         with self._lock:
             self._active = True
+            self._stopping = threading.Event()
             self._complete = threading.Event()
         t = threading.Thread(target=self._update_loop)
         t.daemon = True
@@ -31,42 +139,140 @@ class DmxClient(object):
 
     def stop(self):
         with self._lock:
+            if not self._active:
+                return
             e = self._complete
             self._active = False
+            self._stopping.set()
+            self._dirty.set()
         e.wait()
 
+    def stats(self):
+        now = time.monotonic()
+        recent = [t for t in self._send_starts if now - t <= 1]
+        return {
+            'fps': len(recent),
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'send_failures': self.send_failures,
+            'send_latency_avg': self.send_time_total / self.frames_sent if self.frames_sent else 0,
+            'send_latency_max': self.send_time_max,
+        }
+
     def _update_loop(self):
-        while self._active:
-            with self._lock:
-                if self._dirty:
-                    try:
-                        self._update_dmx()
-                    except requests.HTTPError as e:
-                        logger.warning('Error sending DMX update: ' + str(e))
-                    self._dirty = False
-            time.sleep(0.02)
+        period = 1.0 / self.frame_rate
+        next_frame = time.monotonic()
+        while True:
+            self._dirty.wait()
+            if not self._active:
+                break
+            now = time.monotonic()
+            next_frame = frame_start(next_frame, period, now)
+            wait = max(next_frame, self._retry_at) - now
+            if wait > 0 and self._stopping.wait(wait):
+                break
+            self._send_frame()
+            next_frame = self._next_frame_time(next_frame, period)
         self._complete.set()
 
-    def _update_dmx(self):
-        url = os.path.join(self.base_url, 'dmx')
+    def _next_frame_time(self, next_frame, period):
+        next_frame, missed = next_frame_time(next_frame, period, time.monotonic())
+        if missed and self._dirty.is_set():
+            self.frames_dropped += missed
+        return next_frame
+
+    def _take_frame(self):
+        t0 = None if self.metrics is None else time.perf_counter()
         with self._lock:
-            r = requests.post(url, data=self._dmx)
-        r.raise_for_status()
+            if t0 is not None:
+                self._lock_time.observe(time.perf_counter() - t0)
+            frame = bytes(self._dmx)
+            self._dirty.clear()
+            self._frame_dirty_since = self._dirty_since
+            self._dirty_since = None
+        return None if frame == self._sent else frame
+
+    def _send_frame(self):
+        frame = self._take_frame()
+        if frame is None:
+            return True
+        path, data, headers = self._encode(frame)
+        if self._session is None:
+            self._session = load_requests().Session()
+        t0 = time.monotonic()
+        try:
+            r = self._session.post(os.path.join(self.base_url, path), data=data, headers=headers,
+                                   timeout=self.timeout)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            self._session.close()
+            self._send_failed(e)
+            return False
+        self._send_succeeded(frame, t0)
+        return True
+
+    def _send_failed(self, error):
+        self._sent = None
+        with self._lock:
+            if self._dirty_since is None:
+                self._dirty_since = self._frame_dirty_since
+        self._dirty.set()
+        self.send_failures += 1
+        self._backoff = min(max(2 * self._backoff, BACKOFF_MIN), BACKOFF_MAX)
+        self._retry_at = time.monotonic() + self._backoff
+        logger.warning('Error sending DMX update (retrying in %gs): %s' % (self._backoff, error))
+
+    def _send_succeeded(self, frame, t0):
+        dt = time.monotonic() - t0
+        self._send_starts.append(t0)
+        self.frames_sent += 1
+        self.send_time_total += dt
+        self.send_time_max = max(self.send_time_max, dt)
+        if self.metrics is not None:
+            self._send_time.observe(dt)
+            if self._frame_dirty_since is not None:
+                self._dirty_time.observe(time.monotonic() - self._frame_dirty_since)
+        self._sent = frame
+        self._backoff = 0
+        if self.recorder is not None:
+            self.recorder.record_frame(frame)
+
+    def _encode(self, frame):
+        if self.encoding == 'hex':
+            return 'dmx', frame.hex().encode('ascii'), None
+        binary = {'Content-Type': 'application/octet-stream'}
+        if self.encoding == 'delta' and self._sent is not None:
+            return 'dmx/spans', encode_spans(frame, changed_spans(self._sent, frame)), binary
+        return 'dmx', frame, binary
+
+    def __getitem__(self, key):
+        return self._dmx[key]
 
     def __setitem__(self, key, value):
+        value = to_byte(value)
+        with self._lock:
+            if self._dmx[key] != value:
+                self._dmx[key] = value
+                self._mark_dirty()
+
+    def set_range(self, start, values):
+        data = values if isinstance(values, (bytes, bytearray)) else bytes(to_byte(v) for v in values)
+        end = start + len(data)
+        if start < 0 or end > CHANNELS:
+            raise ValueError("DMX channels %d-%d are outside the range [0, %d)" % (start, end - 1, CHANNELS))
         with self._lock:
-            if isinstance(value, float):
-                value = int(round(value))
-            if value < 0:
-                value = 0
-            if value > 255:
-                value = 255
-            new_value = bytearray(format(value, '02x'), encoding='ascii')
-            i0 = 2 * key
-            for i in (0, 1):
-                if self._dmx[i0 + i] != new_value[i]:
-                    self._dmx[i0 + i] = new_value[i]
-                    self._dirty = True
+            if self._dmx[start:end] != data:
+                self._dmx[start:end] = data
+                self._mark_dirty()
+
+    def fill(self, start, end, value):
+        self.set_range(start, bytes((to_byte(value),)) * (end - start))
+
+    @contextlib.contextmanager
+    def edit(self):
+        with self._lock:
+            yield self._dmx
+            self._mark_dirty()
 
     def set16(self, channel, value):
         if isinstance(value, float):
@@ -79,5 +285,14 @@ class DmxClient(object):
             self[channel] = value // 256
             self[channel+1] = value % 256
 
+    def _mark_dirty(self):
+        if self._dirty_since is None and self.metrics is not None:
+            self._dirty_since = time.monotonic()
+        self._dirty.set()
+        if self._on_dirty is not None:
+            self._on_dirty()
+
     def __del__(self):
         self.stop()
+        if self._session is not None:
+            self._session.close()
@@ -0,0 +1,177 @@
+import contextlib
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import threading
+import time
+from dmx import CHANNELS, ENCODINGS, FRAME_RATE, SEND_TIMEOUT, DmxClient, to_byte
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+# Slots of the shared header, each an unsigned 64-bit integer. SEQ is odd while the control
+# process is writing the universe; the rest are published by the output process.
+SEQ, FPS, FRAMES_SENT, FRAMES_DROPPED, SEND_FAILURES, SEND_TIME_TOTAL_US, SEND_TIME_MAX_US = range(7)
+HEADER_SIZE = 8 * 8
+STOP_TIMEOUT = 5
+
+
+# Same channel interface as DmxClient, but the universe lives in shared memory and a separate
+# output process polls it at the frame rate and does all the HTTP work, so sending never
+# competes with the control loop for the GIL. Channel writes only touch the shared buffer.
+class ProcessDmxClient(object):
+    def __init__(self, base_url, encoding='hex', timeout=SEND_TIMEOUT, frame_rate=FRAME_RATE, metrics=None):
+        if encoding not in ENCODINGS:
+            raise ValueError("DMX encoding '%s' is not one of %s" % (encoding, ', '.join(ENCODINGS)))
+        self.base_url = base_url
+        self.encoding = encoding
+        self.timeout = timeout
+        self.frame_rate = frame_rate
+        self._shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + CHANNELS)
+        self._counters = self._shm.buf[:HEADER_SIZE].cast('Q')
+        self._dmx = self._shm.buf[HEADER_SIZE:HEADER_SIZE + CHANNELS]
+        self._lock = threading.RLock()
+        self._process = None
+        self._stopping = None
+        self.metrics = metrics
+        if metrics is not None:
+            labels = {'url': base_url}
+            metrics.gauge('dmx_frames_per_second', 'DMX frames sent in the last second',
+                          lambda: self._counters[FPS], labels)
+            metrics.counter('dmx_frames_sent_total', 'DMX frames sent', lambda: self._counters[FRAMES_SENT], labels)
+            metrics.counter('dmx_frames_dropped_total', 'DMX frame slots missed while dirty',
+                            lambda: self._counters[FRAMES_DROPPED], labels)
+            metrics.counter('dmx_send_failures_total', 'Failed DMX frame sends',
+                            lambda: self._counters[SEND_FAILURES], labels)
+
+    def start(self):
+        if self._process is not None:
+            return
+        context = multiprocessing.get_context('spawn')
+        self._stopping = context.Event()
+        self._process = context.Process(
+            target=output_loop, name='dmx-output', daemon=True,
+            args=(self._shm.name, self.base_url, self.encoding, self.timeout, self.frame_rate, self._stopping))
+        self._process.start()
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._stopping.set()
+        self._process.join(STOP_TIMEOUT)
+        if self._process.is_alive():
+            logger.warning("DMX output process did not stop, terminating it")
+            self._process.terminate()
+            self._process.join()
+        self._process = None
+
+    def close(self):
+        self.stop()
+        if self._shm is None:
+            return
+        self._counters.release()
+        self._dmx.release()
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def stats(self):
+        frames_sent = self._counters[FRAMES_SENT]
+        return {
+            'fps': self._counters[FPS],
+            'frames_sent': frames_sent,
+            'frames_dropped': self._counters[FRAMES_DROPPED],
+            'send_failures': self._counters[SEND_FAILURES],
+            'send_latency_avg': 1e-6 * self._counters[SEND_TIME_TOTAL_US] / frames_sent if frames_sent else 0,
+            'send_latency_max': 1e-6 * self._counters[SEND_TIME_MAX_US],
+        }
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytearray(self._dmx[key])
+        return self._dmx[key]
+
+    def __setitem__(self, key, value):
+        value = to_byte(value)
+        with self._lock:
+            if self._dmx[key] != value:
+                self._counters[SEQ] += 1
+                self._dmx[key] = value
+                self._counters[SEQ] += 1
+
+    def set_range(self, start, values):
+        data = values if isinstance(values, (bytes, bytearray)) else bytes(to_byte(v) for v in values)
+        end = start + len(data)
+        if start < 0 or end > CHANNELS:
+            raise ValueError("DMX channels %d-%d are outside the range [0, %d)" % (start, end - 1, CHANNELS))
+        with self._lock:
+            if self._dmx[start:end] != data:
+                self._counters[SEQ] += 1
+                self._dmx[start:end] = data
+                self._counters[SEQ] += 1
+
+    def fill(self, start, end, value):
+        self.set_range(start, bytes((to_byte(value),)) * (end - start))
+
+    @contextlib.contextmanager
+    def edit(self):
+        with self._lock:
+            self._counters[SEQ] += 1
+            try:
+                yield self._dmx
+            finally:
+                self._counters[SEQ] += 1
+
+    def set16(self, channel, value):
+        if isinstance(value, float):
+            value = int(round(value * 0xffff))
+        if value < 0:
+            value = 0
+        if value > 0xffff:
+            value = 0xffff
+        with self._lock:
+            self[channel] = value // 256
+            self[channel+1] = value % 256
+
+    def __del__(self):
+        self.close()
+
+
+# Runs in the output process: copies the shared universe whenever its sequence number has moved
+# and is even, and sends it through a DmxClient on the client's own frame cadence and backoff
+def output_loop(name, base_url, encoding, timeout, frame_rate, stopping):
+    shm = shared_memory.SharedMemory(name)
+    counters = shm.buf[:HEADER_SIZE].cast('Q')
+    universe = shm.buf[HEADER_SIZE:HEADER_SIZE + CHANNELS]
+    client = DmxClient(base_url, encoding, timeout, frame_rate)
+    period = 1.0 / frame_rate
+    next_frame = time.monotonic()
+    seen = None
+    try:
+        while not stopping.is_set():
+            seq = counters[SEQ]
+            if seq != seen and seq % 2 == 0:
+                frame = bytes(universe)
+                if counters[SEQ] == seq:
+                    seen = seq
+                    if frame != client._dmx:
+                        client._dmx[:] = frame
+                        client._mark_dirty()
+            if client._dirty.is_set() and client._retry_at <= time.monotonic():
+                client._send_frame()
+            next_frame = client._next_frame_time(next_frame, period)
+            counters[FPS] = client.stats()['fps']
+            counters[FRAMES_SENT] = client.frames_sent
+            counters[FRAMES_DROPPED] = client.frames_dropped
+            counters[SEND_FAILURES] = client.send_failures
+            counters[SEND_TIME_TOTAL_US] = int(1e6 * client.send_time_total)
+            counters[SEND_TIME_MAX_US] = int(1e6 * client.send_time_max)
+            stopping.wait(max(0, next_frame - time.monotonic()))
+    finally:
+        if client._session is not None:
+            client._session.close()
+        counters.release()
+        universe.release()
+        shm.close()
@@ -0,0 +1,130 @@
+import argparse
+import http.server
+import logging
+import threading
+import time
+import urllib.parse
+from dmx import CHANNELS, SPAN_HEADER
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+
+# Stand-in for dotnet/DmxServer that speaks the same HTTP interface but keeps
+# the universe in memory instead of writing it to a DMX serial adapter.
+class DmxRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/status':
+            self._respond(200, 'DMX stand-in ready')
+        elif url.path == '/dmx':
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                if not all(k.startswith('ch') for k in query):
+                    raise ValueError('Unrecognized argument in ' + url.query)
+                updates = {int(k[2:]): int(v[-1]) for k, v in query.items()}
+                self.server.set_spans([(channel, bytes((value,))) for channel, value in updates.items()])
+            except (ValueError, KeyError) as e:
+                self._respond(400, str(e))
+                return
+            self._respond(200, 'OK')
+        else:
+            self._respond(404, 'Path %s not found' % url.path)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        binary = self.headers.get('Content-Type', '').startswith('application/octet-stream')
+        try:
+            if self.path == '/dmx':
+                if binary and len(body) == CHANNELS:
+                    self.server.set_spans([(0, body)])
+                elif not binary and len(body) == 2 * CHANNELS:
+                    self.server.set_spans([(0, bytes.fromhex(body.decode('ascii')))])
+                else:
+                    raise ValueError('Expected %d bytes of DMX data in request body' % CHANNELS)
+            elif self.path == '/dmx/spans':
+                spans = []
+                offset = 0
+                while offset < len(body):
+                    start, length = SPAN_HEADER.unpack_from(body, offset)
+                    offset += SPAN_HEADER.size
+                    spans.append((start, body[offset:offset + length]))
+                    offset += length
+                self.server.set_spans(spans)
+            else:
+                self._respond(404, 'Path %s not found' % self.path)
+                return
+        except Exception as e:
+            self._respond(400, str(e))
+            return
+        self._respond(200, 'OK')
+
+    def _respond(self, code, content):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        data = ('<html><body>%s</body></html>' % content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class DmxServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        super(DmxServer, self).__init__((host, port), DmxRequestHandler)
+        self.delay = delay
+        self.dmx = bytearray(CHANNELS)
+        self.frames = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def set_spans(self, spans):
+        with self._lock:
+            for start, data in spans:
+                if start + len(data) > CHANNELS:
+                    raise ValueError('Span of %d channels starting at %d exceeds %d channels' % (
+                        len(data), start, CHANNELS))
+                if start == 0 and data and data[0] != 0:
+                    raise ValueError('DMX channel 0 may only have value 0')
+            for start, data in spans:
+                self.dmx[start:start + len(data)] = data
+            self.frames += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory stand-in for DmxServer')
+    parser.add_argument('port', type=int, nargs='?', default=8080)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--delay', type=float, default=0, help='Seconds to wait before each response')
+    args = parser.parse_args()
+
+    server = DmxServer(args.host, args.port, args.delay)
+    logger.info('Listening at ' + server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import collections
+import logging
+import os
+import queue
+import selectors
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+HubEvent = collections.namedtuple('HubEvent', ('panel', 'change'))
+
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 10
+
+
+# Watches the serial ports of any number of panels from a single selector thread
+# and merges their input changes into one event queue tagged by panel.
+class PanelHub(object):
+    def __init__(self):
+        self.panels = []
+        self._selector = selectors.DefaultSelector()
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self._added = []
+        self._dropped = []
+        self._reconnects = {}
+        self._fds = {}
+        self._stopping = False
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def open(self, layout, port, **kwargs):
+        return layout(port, hub=self, **kwargs)
+
+    def add(self, panel):
+        panel.subscribe(lambda change: self._events.put(HubEvent(panel, change)))
+        with self._lock:
+            self.panels.append(panel)
+            self._added.append(panel)
+        self._wake()
+
+    # Drops a panel's connection from the hub thread, e.g. when its heartbeat goes unanswered
+    def drop(self, panel):
+        with self._lock:
+            self._dropped.append(panel)
+        self._wake()
+
+    def get_event(self, timeout=None):
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def events(self, timeout=0):
+        event = self.get_event(timeout)
+        while event is not None:
+            yield event
+            event = self.get_event(0)
+
+    def close(self):
+        self._stopping = True
+        self._wake()
+        self._thread.join()
+        # Closing the panels rather than just their ports also stops their heartbeat and reconnect threads
+        for panel in self.panels:
+            panel.close()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def _loop(self):
+        while not self._stopping:
+            for key, mask in self._selector.select(self._timeout()):
+                if key.data is None:
+                    self._on_wake()
+                else:
+                    self._on_readable(key.data)
+            self._retry_reconnects()
+        logger.info("Exited hub loop")
+
+    def _timeout(self):
+        if not self._reconnects:
+            return None
+        return max(0, min(t for t, delay in self._reconnects.values()) - time.monotonic())
+
+    def _on_wake(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            added = self._added
+            self._added = []
+            dropped = self._dropped
+            self._dropped = []
+        for panel in added:
+            self._register(panel)
+        for panel in dropped:
+            if panel in self._fds:
+                self._disconnect(panel, ConnectionError("Connection dropped"))
+
+    def _register(self, panel):
+        fd = panel._ser.fileno()
+        self._selector.register(fd, selectors.EVENT_READ, panel)
+        self._fds[panel] = fd
+
+    def _on_readable(self, panel):
+        try:
+            chunk = panel._ser.read(max(1, panel._ser.in_waiting))
+        except Exception as e:
+            logger.error("Error reading from %s on %s: %s" % (type(panel).__name__, panel.port, e))
+            self._disconnect(panel, e)
+            return
+        try:
+            panel._on_data(chunk)
+        except Exception as e:
+            logger.error("Error handling input from %s on %s: %s" % (type(panel).__name__, panel.port, e))
+
+    def _disconnect(self, panel, error):
+        self._selector.unregister(self._fds.pop(panel))
+        panel._on_disconnected(error)
+        if isinstance(panel.port, str) and not panel._closing.is_set():
+            self._reconnects[panel] = (time.monotonic() + RECONNECT_MIN, RECONNECT_MIN)
+
+    def _retry_reconnects(self):
+        now = time.monotonic()
+        for panel, (t, delay) in list(self._reconnects.items()):
+            if t > now:
+                continue
+            try:
+                panel._reopen()
+            except Exception as e:
+                delay = min(2 * delay, RECONNECT_MAX)
+                logger.debug("Reconnecting %s on %s failed: %s" % (type(panel).__name__, panel.port, e))
+                self._reconnects[panel] = (now + delay, delay)
+                continue
+            del self._reconnects[panel]
+            self._register(panel)
+            logger.info("Reconnected %s on %s" % (type(panel).__name__, panel.port))
+            # A reopened board may reset; resynchronize it once it reports READY again
+            panel._on_reconnected()
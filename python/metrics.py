@@ -0,0 +1,182 @@
+import bisect
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+# Exponential bucket bounds in seconds, from 10us to about 10s
+DEFAULT_BUCKETS = tuple(1e-5 * 2 ** i for i in range(21))
+LOG_INTERVAL = 10
+
+
+def format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+
+
+class Histogram(object):
+    def __init__(self, name, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    # Upper bound of the bucket holding the q-th quantile (the maximum for the overflow bucket)
+    def quantile(self, q):
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return 0
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+    def prometheus(self):
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else '%g' % bound
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, ('le', le)), cumulative))
+        lines.append('%s_sum%s %r' % (self.name, format_labels(self.labels), total))
+        lines.append('%s_count%s %d' % (self.name, format_labels(self.labels), count))
+        return lines
+
+
+class Gauge(object):
+    def __init__(self, name, labels, func):
+        self.name = name
+        self.labels = labels
+        self.func = func
+
+    def value(self):
+        return self.func()
+
+    def prometheus(self):
+        return ['%s%s %r' % (self.name, format_labels(self.labels), self.value())]
+
+
+# Collects histograms and gauges from any number of panels and DMX clients. Instrumented
+# objects take a registry as `metrics=` and skip all measurement when it is None.
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._types = {}
+        self._lock = threading.Lock()
+        self._log_stop = None
+
+    def histogram(self, name, help_text, labels=None, buckets=DEFAULT_BUCKETS):
+        return self._add(name, help_text, 'histogram', labels, lambda l: Histogram(name, l, buckets))
+
+    # Registering a gauge or counter again replaces its callback, so a recreated panel or client
+    # with the same labels reports itself rather than the instance it replaced
+    def gauge(self, name, help_text, func, labels=None):
+        metric = self._add(name, help_text, 'gauge', labels, lambda l: Gauge(name, l, func))
+        metric.func = func
+        return metric
+
+    def counter(self, name, help_text, func, labels=None):
+        metric = self._add(name, help_text, 'counter', labels, lambda l: Gauge(name, l, func))
+        metric.func = func
+        return metric
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.items())
+        result = {}
+        for (name, labels), metric in metrics:
+            key = name + format_labels(labels)
+            result[key] = metric.summary() if isinstance(metric, Histogram) else metric.value()
+        return result
+
+    def prometheus(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+        lines = []
+        last_name = None
+        for (name, labels), metric in metrics:
+            if name != last_name:
+                lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s %s' % (name, self._types[name]))
+                last_name = name
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def log_line(self):
+        parts = []
+        for key, value in sorted(self.snapshot().items()):
+            if isinstance(value, dict):
+                if value['count']:
+                    parts.append('%s n=%d p50=%.2fms p99=%.2fms' % (
+                        key, value['count'], 1e3 * value['p50'], 1e3 * value['p99']))
+            else:
+                parts.append('%s=%g' % (key, value))
+        return '; '.join(parts)
+
+    def start_logging(self, interval=LOG_INTERVAL):
+        self.stop_logging()
+        self._log_stop = stop = threading.Event()
+
+        def log_loop():
+            while not stop.wait(interval):
+                logger.info(self.log_line())
+
+        t = threading.Thread(target=log_loop)
+        t.daemon = True
+        t.start()
+
+    def stop_logging(self):
+        if self._log_stop is not None:
+            self._log_stop.set()
+            self._log_stop = None
+
+    def _add(self, name, help_text, metric_type, labels, factory):
+        labels = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            if self._types.setdefault(name, metric_type) != metric_type:
+                raise ValueError("Metric %s is already registered as a %s" % (name, self._types[name]))
+            self._help.setdefault(name, help_text)
+            metric = self._metrics.get((name, labels))
+            if metric is None:
+                metric = self._metrics[(name, labels)] = factory(labels)
+        return metric
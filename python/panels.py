@@ -1,5 +1,13 @@
+from array import array
+import collections
+from concurrent import futures
+import itertools
+import json
 import logging
+import math
+import os
 import serial
+import sys
 import threading
 import time
 
@@ -8,6 +16,28 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'layouts')
+LAYOUT_KEYS = {
+    'switches': 'SWITCHES',
+    'binary_indicators': 'BINARY_INDICATORS',
+    'colored_leds': 'COLORED_LEDS',
+    'analogs': 'ANALOGS',
+    'servos': 'SERVOS',
+}
+
+Change = collections.namedtuple('Change', ('kind', 'name', 'value', 'timestamp'))
+PanelState = collections.namedtuple('PanelState', ('switches', 'analogs'))
+
+# Servo motion curves, mapping the fraction of a move's duration elapsed to the fraction of its travel
+SERVO_CURVES = {
+    'linear': lambda x: x,
+    'ease_in': lambda x: x * x,
+    'ease_out': lambda x: x * (2 - x),
+    'ease_in_out': lambda x: x * x * (3 - 2 * x),
+    'sine': lambda x: 0.5 - 0.5 * math.cos(math.pi * x),
+}
+
+
 class Colors:
     OFF = 0
     RED = 1
@@ -15,6 +45,150 @@ class Colors:
     BLUE = 4
 
 
+# Smooths one analog input and suppresses changes within a deadband or closer together than min_interval.
+# Boards push an analog only when it moves, so nothing more arrives once the input stops: after `settle`
+# quiet seconds a lagging smoother catches up with the last raw sample, which still has to clear the
+# deadband to change the value, and a change held back by min_interval is reported once the interval
+# has passed. due() tells when flush() has something to do.
+class AnalogFilter(object):
+    SMOOTHING = (None, 'ema', 'median')
+    SETTLE = 0.25
+
+    def __init__(self, smoothing=None, alpha=0.25, window=5, deadband=0, min_interval=0, settle=SETTLE):
+        if smoothing not in self.SMOOTHING:
+            raise ValueError("Unknown analog smoothing '%s'" % smoothing)
+        self.smoothing = smoothing
+        self.alpha = alpha
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.settle = settle
+        self.value = None
+        self.raw = None
+        self._updated_at = None
+        self._smoothed = None
+        self._window = collections.deque(maxlen=window)
+        self._reported = None
+        self._reported_at = None
+
+    def update(self, raw, t):
+        self.raw = raw
+        self._updated_at = t
+        if self.smoothing == 'ema':
+            self._smoothed = raw if self._smoothed is None else self._smoothed + self.alpha * (raw - self._smoothed)
+        elif self.smoothing == 'median':
+            self._window.append(raw)
+            self._smoothed = sorted(self._window)[len(self._window) // 2]
+        else:
+            self._smoothed = raw
+        if self.value is None or abs(self._smoothed - self.value) > self.deadband:
+            self.value = int(round(self._smoothed))
+        return self._report(t)
+
+    def due(self):
+        due = None
+        if self._lagging() and self.settle is not None:
+            due = self._updated_at + self.settle
+        if self.value != self._reported:
+            held = self._reported_at + self.min_interval
+            due = held if due is None else min(due, held)
+        return due
+
+    def flush(self, t):
+        if self._lagging() and self.settle is not None and t - self._updated_at >= self.settle:
+            self._smoothed = self.raw
+            self._window.clear()
+            self._window.append(self.raw)
+            self.value = self.raw
+        return self._report(t)
+
+    # The smoother has not caught up with the last sample, which is outside the deadband
+    def _lagging(self):
+        return self._smoothed != self.raw and abs(self.raw - self.value) > self.deadband
+
+    def _report(self, t):
+        if self.value != self._reported and (self._reported_at is None or
+                                              t - self._reported_at >= self.min_interval):
+            self._reported = self.value
+            self._reported_at = t
+            return True
+        return False
+
+
+# Resolves a query future unless it is already done, e.g. cancelled by a caller that timed out
+# after the future was taken from the pending table but before it was resolved
+def _resolve(future, value=None, error=None):
+    try:
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+    except futures.InvalidStateError:
+        pass
+
+
+SERVO_PRIORITY, INDICATOR_PRIORITY, QUERY_PRIORITY = range(3)
+PRIORITY_NAMES = ('servo', 'indicator', 'query')
+
+
+# Outbound commands waiting for a panel's writer thread, in one FIFO per priority class. A
+# command with a target replaces the queued command to that target in place, so only the
+# latest value is sent; targetless commands such as queries are always appended.
+class CommandQueue(object):
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Command queue size must be at least 1, not %s" % size)
+        self.size = size
+        self.closed = False
+        self._queues = tuple(collections.OrderedDict() for _ in PRIORITY_NAMES)
+        self._count = 0
+        self._seq = itertools.count()
+        self._changed = threading.Condition()
+
+    def __len__(self):
+        return self._count
+
+    def put(self, priority, target, cmd, timeout=None):
+        with self._changed:
+            queue = self._queues[priority]
+            if target is not None and target in queue:
+                queue[target] = (queue[target][0], cmd)
+                return
+            if not self._changed.wait_for(lambda: self._count < self.size or self.closed, timeout):
+                raise TimeoutError("Command queue stayed full for %gs" % timeout)
+            queue[next(self._seq) if target is None else target] = (time.perf_counter(), cmd)
+            self._count += 1
+            self._changed.notify_all()
+
+    # Waits for commands and takes them highest priority first, up to `max_bytes` unless a
+    # single command is longer; returns (priority, enqueue time, command) tuples, or None once closed
+    def get(self, max_bytes):
+        with self._changed:
+            self._changed.wait_for(lambda: self._count or self.closed)
+            if self.closed:
+                return None
+            batch = []
+            n = 0
+            for priority, queue in enumerate(self._queues):
+                while queue:
+                    key = next(iter(queue))
+                    t, cmd = queue[key]
+                    if batch and n + len(cmd) > max_bytes:
+                        break
+                    del queue[key]
+                    batch.append((priority, t, cmd))
+                    n += len(cmd)
+                if queue:
+                    break
+            self._count -= len(batch)
+            self._changed.notify_all()
+            return batch
+
+    def close(self):
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+
 class Panel(object):
     SWITCHES = {}
     BINARY_INDICATORS = {}
@@ -22,174 +196,925 @@ class Panel(object):
     ANALOGS = {}
     SERVOS = {}
     ANALOG_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    ANALOG_RANGE = len(ANALOG_DIGITS) ** 2
     SERVO_DIGITS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
     SERVO_BASE = 14
     SWITCH_PREFIX = 'Switch '
     ANALOG_PREFIX = 'Analog '
+    SWITCH_KIND = 'switch'
+    ANALOG_KIND = 'analog'
     READY_KEY = 'Ready'
+    ID_KEY = 'Id'
+    READY_TIMEOUT = 10
+    QUERY_TIMEOUT = 1
+    BAUDRATE = 115200
+    SERVO_MAX = 180
+    COLORS = range(8)
+    WRITE_CHUNK = 32
+    WRITE_TIMEOUT = 1
+    RECONNECT_MIN = 0.5
+    RECONNECT_MAX = 10
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile_encoders()
+
+    @classmethod
+    def from_layout(cls, layout):
+        if isinstance(layout, str):
+            if not os.path.isfile(layout):
+                layout = os.path.join(LAYOUT_DIR, layout + '.json')
+            with open(layout) as f:
+                layout = json.load(f)
+        unknown = set(layout) - set(LAYOUT_KEYS) - {'name'}
+        if unknown:
+            raise ValueError("Unknown panel layout entries: %s" % ', '.join(sorted(unknown)))
+        attrs = {attr: set(layout.get(key, ())) for key, attr in LAYOUT_KEYS.items()}
+        attrs['__module__'] = __name__
+        return type(str(layout['name']), (cls,), attrs)
 
-    def __init__(self, port):
+    def __init__(self, port, autoflush=True, hub=None, recorder=None, metrics=None, state_file=None,
+                 queue_size=None, heartbeat=None):
         self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.autoflush = autoflush
+        self.port = port
+        self.recorder = recorder
+        self.metrics = metrics
+        self.state_file = state_file
+        self.reconciled = None
+        self.heartbeat = heartbeat
+        self.connected = True
+        self.reconnects = 0
+        self._hub = hub
+        self._closing = threading.Event()
+        self._queue = None if queue_size is None else CommandQueue(queue_size)
+        if metrics is not None:
+            labels = {'panel': type(self).__name__, 'port': port if isinstance(port, str) else type(port).__name__}
+            self._dispatch_time = metrics.histogram(
+                'panel_dispatch_seconds', 'Time from reading serial input to dispatching its last line', labels)
+            self._query_time = metrics.histogram(
+                'panel_query_seconds', 'Round trip time of panel queries', labels)
+            self._write_time = metrics.histogram(
+                'panel_write_seconds', 'Time spent waiting for and writing commands to the serial port', labels)
+            if self._queue is not None:
+                metrics.gauge('panel_queue_depth', 'Commands waiting for the panel writer thread',
+                              lambda: len(self._queue), labels)
+                self._queue_wait_time = [metrics.histogram(
+                    'panel_queue_wait_seconds', 'Time commands wait in the panel writer queue',
+                    dict(labels, priority=name)) for name in PRIORITY_NAMES]
+            metrics.counter('panel_reconnects_total', 'Times the panel connection was reopened',
+                            lambda: self.reconnects, labels)
 
-        self._ser = serial.Serial(port, baudrate=115200)
+        if isinstance(port, str):
+            self._ser = serial.Serial(port, baudrate=self.BAUDRATE)
+        else:
+            self._ser = port
+        self._in_buf = bytearray()
 
-        self._values = {}
-        self._value_events = {}
-        self._changed_keys = set()
+        self._switch_slot, self._analog_slot = self._slots()
+        self._switch_bits = 0
+        # Inputs whose value has been reported or seeded; replies repeating a known value are not changes
+        self._switch_known = 0
+        self._analog_known = 0
+        self._analog_values = array('H', [0]) * len(self._analog_slot)
+        self._value_futures = {}
+        self._changes = {self.SWITCH_KIND: {}, self.ANALOG_KIND: {}}
+        self._changed = threading.Condition(self._lock)
+        self._subscribers = ()
+        self._outputs = {}
+        self._pending_outputs = {}
+        self._analog_push = {}
+        self._analog_filters = {}
+        self._filter_timer = None
+        self._filter_due = None
+        self._calibrations = {}
+        self._servo_positions = {}
+        self._motions = {}
+        self._motion_changed = threading.Condition()
+        self._motion_thread = None
+        seeded = state_file is not None and self._load_state(state_file)
 
-        t = threading.Thread(target=self._listen_loop)
-        t.daemon = True
-        t.start()
+        if self._queue is not None:
+            t = threading.Thread(target=self._writer_loop)
+            t.daemon = True
+            t.start()
+
+        if hub is None:
+            t = threading.Thread(target=self._listen_loop)
+            t.daemon = True
+            t.start()
+        else:
+            hub.add(self)
+
+        if heartbeat is not None:
+            t = threading.Thread(target=self._heartbeat_loop)
+            t.daemon = True
+            t.start()
+
+        if seeded:
+            # Start from the saved inputs right away; differences from the live board arrive as changes
+            logger.info("Starting from saved state in %s, reconciling in the background" % state_file)
+            self.reconciled = self.resync()
+            return
 
         logger.info("Waiting for READY")
         self.wait_ready()
 
-        logger.info("Initializing switches")
-        for switch in self.SWITCHES:
-            print(switch)
-            self.read_switch(switch)
-        logger.info("Initializing analogs")
-        for analog in self.ANALOGS:
-            self.read_analog(analog)
+        logger.info("Initializing switches and analogs")
+        self.read_all()
         logger.info("Initialization complete")
 
     def send_command(self, cmd):
-        logger.debug("Command: " + cmd)
-        self._ser.write((cmd + '\n').encode('ascii'))
+        logger.debug("Command: %s", cmd)
+        self._send((cmd + '\n').encode('ascii'))
 
-    def wait_ready(self):
-        self._get_value(self.READY_KEY, '*READY')
+    def send_commands(self, cmds):
+        logger.debug("Commands: %s", ' '.join(cmds))
+        self._send(''.join(cmd + '\n' for cmd in cmds).encode('ascii'))
+
+    def flush(self):
+        with self._lock:
+            if not self._pending_outputs:
+                return
+            outputs = self._pending_outputs
+            self._outputs.update(outputs)
+            self._pending_outputs = {}
+        logger.debug("Outputs: %s", b''.join(outputs.values()))
+        self._send_outputs(outputs)
+
+    def close(self):
+        self._closing.set()
+        self.connected = False
+        if self._queue is not None:
+            self._queue.close()
+        with self._lock:
+            if self._filter_timer is not None:
+                self._filter_timer.cancel()
+        self._drop_link()
+        try:
+            self._ser.close()
+        except Exception:
+            pass
+
+    def identify(self, timeout=None):
+        return self._get_value(self.ID_KEY, '*RID', timeout)
+
+    def wait_ready(self, timeout=None):
+        self._get_value(self.READY_KEY, '*READY', self.READY_TIMEOUT if timeout is None else timeout)
 
     def set_indicator(self, indicator, value):
-        if indicator in self.BINARY_INDICATORS:
-            cmd = 'S%s%s' % (indicator, '1' if value else '0')
-        elif indicator in self.COLORED_LEDS:
-            cmd = 'S%s%s' % (indicator, value)
-        else:
-            raise ValueError("Indicator '%s' does not exist in %s" % (indicator, type(self).__name__))
-        self.send_command(cmd)
+        self._set_output(*self._indicator_command(indicator, value))
 
     def set_servo(self, servo, value):
+        target, cmd = self._servo_command(servo, value)
+        if servo in self._motions:
+            self.stop_servo(servo)
+        self._servo_positions[servo] = value
+        self._set_output(target, cmd)
+
+    # Moves a servo from its last commanded position to `target` over `duration` seconds along
+    # `curve`, a name from SERVO_CURVES or a function of the elapsed fraction. Positions are
+    # streamed from a background thread as soon as they change, bypassing autoflush, and a
+    # later move or set_servo on the same servo retargets or cancels the move.
+    def move_servo(self, servo, target, duration, curve='linear'):
+        target_key, cmd = self._servo_command(servo, target)
+        if duration < 0:
+            raise ValueError("Servo move duration %g is negative" % duration)
+        if not callable(curve):
+            if curve not in SERVO_CURVES:
+                raise ValueError("Unknown servo curve '%s'" % curve)
+            curve = SERVO_CURVES[curve]
+        with self._motion_changed:
+            start = self._servo_positions.get(servo, target)
+            steps = self._servo_trajectory(servo, start, target, duration, curve, 10 * len(cmd) / self.BAUDRATE)
+            self._motions[servo] = [time.monotonic(), target_key, steps, 0]
+            if self._motion_thread is None:
+                self._motion_thread = threading.Thread(target=self._motion_loop)
+                self._motion_thread.daemon = True
+                self._motion_thread.start()
+            self._motion_changed.notify()
+
+    def stop_servo(self, servo):
         if servo not in self.SERVOS:
             raise ValueError("Servo '%s' does not exist in %s" % (servo, type(self).__name__))
-        if value < 0 or value > 180:
-            raise ValueError("Servo value %g is outside the range [0, 180]" % value)
-        value = round(value)
-        s = self.SERVO_DIGITS[value // self.SERVO_BASE] + self.SERVO_DIGITS[value % self.SERVO_BASE]
-        self.send_command('T%s%s' % (servo, s))
+        with self._motion_changed:
+            self._motions.pop(servo, None)
+        return self._servo_positions.get(servo)
+
+    def servo_moving(self, servo):
+        return servo in self._motions
 
-    def read_switch(self, switch):
+    def read_switch(self, switch, timeout=None):
         if switch not in self.SWITCHES:
             raise ValueError("Switch '%s' does not exist in %s" % (switch, type(self).__name__))
-        return self._get_value(self._switch_key(switch), 'QS%s' % switch)
+        return self._get_value(self._switch_key(switch), 'QS%s' % switch, timeout)
+
+    def read_switches(self, switches=None, timeout=None):
+        return self.read_all(self.SWITCHES if switches is None else switches, (), timeout)[0]
 
     def get_switch(self, switch):
-        if switch not in self.SWITCHES:
+        slot = self._switch_slot.get(switch)
+        if slot is None:
             raise ValueError("Switch '%s' does not exist in %s" % (switch, type(self).__name__))
-        with self._lock:
-            return self._values[self._switch_key(switch)]
+        return self._switch_bits >> slot & 1 == 1
 
-    def read_analog(self, analog):
+    def read_analog(self, analog, timeout=None):
         if analog not in self.ANALOGS:
             raise ValueError("Analog input '%s' does not exist in %s" % (analog, type(self).__name__))
-        return self._get_value(self._analog_key(analog), 'QA%s' % analog)
+        return self._get_value(self._analog_key(analog), 'QA%s' % analog, timeout)
+
+    def read_analogs(self, analogs=None, timeout=None):
+        return self.read_all((), self.ANALOGS if analogs is None else analogs, timeout)[1]
 
     def get_analog(self, analog):
+        slot = self._analog_slot.get(analog)
+        if slot is None:
+            raise ValueError("Analog input '%s' does not exist in %s" % (analog, type(self).__name__))
+        return self._analog_values[slot]
+
+    def snapshot(self):
+        with self._lock:
+            return PanelState(self._switch_bits, array('H', self._analog_values))
+
+    def diff(self, old, new=None):
+        if new is None:
+            new = self.snapshot()
+        switch_names, analog_names = self._slot_names()
+        flipped = old.switches ^ new.switches
+        switches = [switch_names[slot] for slot in range(len(switch_names)) if flipped >> slot & 1]
+        analogs = [analog_names[slot] for slot in range(len(analog_names)) if old.analogs[slot] != new.analogs[slot]]
+        return switches, analogs
+
+    def configure_analog(self, analog, smoothing=None, alpha=0.25, window=5, deadband=0, min_interval=0,
+                         calibration=None, settle=AnalogFilter.SETTLE):
         if analog not in self.ANALOGS:
             raise ValueError("Analog input '%s' does not exist in %s" % (analog, type(self).__name__))
+        analog_filter = AnalogFilter(smoothing, alpha, window, deadband, min_interval, settle)
         with self._lock:
-            return self._values[self._analog_key(analog)]
+            analog_filter.update(self._analog_values[self._analog_slot[analog]], time.monotonic())
+            if smoothing is None and deadband == 0 and min_interval == 0:
+                self._analog_filters.pop(analog, None)
+            else:
+                self._analog_filters[analog] = analog_filter
+            if calibration is None:
+                self._calibrations.pop(analog, None)
+            else:
+                self._calibrations[analog] = [calibration(x) for x in range(self.ANALOG_RANGE)]
 
-    def changed_switches(self):
-        return self._changed_values(self.SWITCH_PREFIX)
+    def set_analog_push(self, analog, enabled=True):
+        if analog not in self.ANALOGS:
+            raise ValueError("Analog input '%s' does not exist in %s" % (analog, type(self).__name__))
+        with self._lock:
+            self._analog_push[analog] = enabled
+        # Push settings are reapplied when the board reconnects
+        if self.connected:
+            self.send_command('PA%s%s' % (analog, '1' if enabled else '0'))
+
+    def get_calibrated(self, analog):
+        table = self._calibrations.get(analog)
+        if table is None:
+            raise ValueError("Analog input '%s' has no calibration in %s" % (analog, type(self).__name__))
+        return table[self._analog_values[self._analog_slot[analog]]]
+
+    # Once the board reports READY, reapplies the last known outputs and analog push settings
+    # and queries every input; the returned future completes with the last reply, since the
+    # board answers queries in order
+    def resync(self):
+        done = futures.Future()
+
+        def query_inputs(ready):
+            try:
+                ready.result()
+                self._reapply_outputs()
+                switch_futures, analog_futures = self.query(self.SWITCHES, self.ANALOGS)
+            except Exception as e:
+                _resolve(done, error=e)
+                return
+            pending = list(switch_futures.values()) + list(analog_futures.values())
+            if pending:
+                self._expire_later(self.QUERY_TIMEOUT)
+                pending[-1].add_done_callback(lambda f: _resolve(done, error=f.exception()))
+            else:
+                _resolve(done)
+
+        ready = self._query_values(((self.READY_KEY, '*READY'),), self.READY_TIMEOUT)[0]
+        ready.add_done_callback(query_inputs)
+        self._expire_later(self.READY_TIMEOUT)
+        return done
+
+    def save_state(self, path=None):
+        path = self.state_file if path is None else path
+        if path is None:
+            raise ValueError("No state file given for %s" % type(self).__name__)
+        state = self.snapshot()
+        switch_names, analog_names = self._slot_names()
+        data = {
+            'panel': type(self).__name__,
+            'switches': {name: state.switches >> slot & 1 == 1 for slot, name in enumerate(switch_names)},
+            'analogs': {name: state.analogs[slot] for slot, name in enumerate(analog_names)},
+        }
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def query(self, switches=(), analogs=()):
+        switches = list(switches)
+        analogs = list(analogs)
+        requests = []
+        for switch in switches:
+            if switch not in self.SWITCHES:
+                raise ValueError("Switch '%s' does not exist in %s" % (switch, type(self).__name__))
+            requests.append((self._switch_key(switch), 'QS%s' % switch))
+        for analog in analogs:
+            if analog not in self.ANALOGS:
+                raise ValueError("Analog input '%s' does not exist in %s" % (analog, type(self).__name__))
+            requests.append((self._analog_key(analog), 'QA%s' % analog))
+        n_switches = len(switches)
+        pending = self._query_values(requests)
+        return dict(zip(switches, pending[:n_switches])), dict(zip(analogs, pending[n_switches:]))
 
-    def changed_analogs(self):
-        return self._changed_values(self.ANALOG_PREFIX)
+    def read_all(self, switches=None, analogs=None, timeout=None):
+        switch_futures, analog_futures = self.query(self.SWITCHES if switches is None else switches,
+                                                    self.ANALOGS if analogs is None else analogs)
+        self._wait_values(list(switch_futures.values()) + list(analog_futures.values()), timeout)
+        return ({s: f.result() for s, f in switch_futures.items()},
+                {a: f.result() for a, f in analog_futures.items()})
+
+    def changed_switches(self, timeout=0):
+        return self._pop_changes(self.SWITCH_KIND, timeout)
+
+    def changed_analogs(self, timeout=0):
+        return self._pop_changes(self.ANALOG_KIND, timeout)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers += (callback,)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s != callback)
+
+    async def changes(self):
+        # Imported here to keep asyncio out of the startup of threaded applications
+        import asyncio
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        callback = lambda change: loop.call_soon_threadsafe(queue.put_nowait, change)
+        self.subscribe(callback)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(callback)
 
     def __del__(self):
         logger.info("Closing serial connection")
         self._ser.close()
 
     def _listen_loop(self):
-        buf = b''
         while True:
             try:
-                c = self._ser.read()
+                chunk = self._ser.read(max(1, self._ser.in_waiting))
+            except Exception as e:
+                if self._closing.is_set():
+                    break
+                logger.error("Error reading from %s on %s: %s" % (type(self).__name__, self.port, e))
+                self._on_disconnected(e)
+                if not isinstance(self.port, str) or not self._reconnect():
+                    break
+                continue
+            try:
+                self._on_data(chunk)
             except Exception as e:
-                logger.error("Error in _listen_loop: " + str(e))
+                logger.error("Error handling input from %s on %s: %s" % (type(self).__name__, self.port, e))
+        logger.info("Exited listen loop")
+
+    def _reconnect(self):
+        delay = self.RECONNECT_MIN
+        while not self._closing.wait(delay):
+            try:
+                self._reopen()
+            except Exception as e:
+                logger.debug("Reconnecting %s on %s failed: %s" % (type(self).__name__, self.port, e))
+                delay = min(2 * delay, self.RECONNECT_MAX)
+                continue
+            logger.info("Reconnected %s on %s" % (type(self).__name__, self.port))
+            self._on_reconnected()
+            return True
+        return False
+
+    # Pending requests fail right away instead of waiting out their deadlines on a dead link
+    def _on_disconnected(self, error):
+        self.connected = False
+        with self._lock:
+            pending = [future for waiting in self._value_futures.values() for future in waiting]
+            self._value_futures.clear()
+        for future in pending:
+            _resolve(future, error=ConnectionError("%s on %s disconnected: %s" % (type(self).__name__, self.port, error)))
+
+    def _on_reconnected(self):
+        self.connected = True
+        self.reconciled = self.resync()
+        self.reconnects += 1
+
+    def _reapply_outputs(self):
+        with self._lock:
+            outputs = dict(self._outputs)
+            pushes = sorted(self._analog_push.items())
+        if outputs:
+            self._send_outputs(outputs)
+        if pushes:
+            self.send_commands(['PA%s%s' % (analog, '1' if enabled else '0') for analog, enabled in pushes])
+
+    # Checks the link with an identification query every `heartbeat` seconds, dropping it to
+    # force a reconnect when the board stops answering, and expires overdue requests
+    def _heartbeat_loop(self):
+        while not self._closing.wait(self.heartbeat):
+            self._expire_requests()
+            if not self.connected:
+                continue
+            try:
+                name = self.identify()
+            except ConnectionError:
+                continue
+            except TimeoutError:
+                if self.connected:
+                    logger.error("No heartbeat from %s on %s, reconnecting" % (type(self).__name__, self.port))
+                    self._drop_link()
+                continue
+            if name != type(self).__name__:
+                logger.warning("%s on %s identifies as %s" % (type(self).__name__, self.port, name))
+            reconciled = self.reconciled
+            if reconciled is not None and reconciled.done() and reconciled.exception() is not None:
+                logger.info("Retrying resynchronization of %s on %s" % (type(self).__name__, self.port))
+                self.reconciled = self.resync()
+
+    def _expire_requests(self):
+        now = time.perf_counter()
+        expired = []
+        with self._lock:
+            for key, waiting in list(self._value_futures.items()):
+                overdue = [future for future in waiting if future.deadline < now]
+                if overdue:
+                    expired.extend(overdue)
+                    waiting[:] = [future for future in waiting if future.deadline >= now]
+                    if not waiting:
+                        del self._value_futures[key]
+        for future in expired:
+            _resolve(future, error=TimeoutError("No response to %s from %s" % (future.cmd, type(self).__name__)))
+
+    # Nothing waits on resync's futures, so they are expired at their deadline even without a heartbeat
+    def _expire_later(self, delay):
+        t = threading.Timer(delay, self._expire_requests)
+        t.daemon = True
+        t.start()
+
+    def _drop_link(self):
+        self.connected = False
+        if self._hub is not None:
+            self._hub.drop(self)
+            return
+        try:
+            if hasattr(self._ser, 'cancel_read'):
+                self._ser.cancel_read()
+            self._ser.close()
+        except Exception:
+            pass
+
+    def _on_data(self, chunk):
+        t0 = None if self.metrics is None else time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.record_input(chunk)
+        buf = self._in_buf
+        buf += chunk
+        end = buf.rfind(b'\n')
+        if end < 0:
+            return
+        lines = bytes(buf[:end]).split(b'\n')
+        del buf[:end + 1]
+        self._on_lines(lines)
+        if t0 is not None:
+            self._dispatch_time.observe(time.perf_counter() - t0)
+
+    def _send(self, data):
+        if not self.connected:
+            raise ConnectionError("%s on %s is disconnected" % (type(self).__name__, self.port))
+        if self._queue is None:
+            self._write(data)
+        else:
+            self._queue.put(QUERY_PRIORITY, None, data, self.WRITE_TIMEOUT)
+
+    def _send_outputs(self, outputs):
+        if not self.connected:
+            # Kept in _outputs and reapplied on reconnect
+            return
+        if self._queue is None:
+            try:
+                self._write(b''.join(outputs.values()))
+            except ConnectionError:
+                pass
+            return
+        for target, cmd in outputs.items():
+            priority = SERVO_PRIORITY if target[0] == 'T' else INDICATOR_PRIORITY
+            self._queue.put(priority, target, cmd, self.WRITE_TIMEOUT)
+
+    # Writes queued commands no faster than the link carries them, so commands stay in the
+    # priority queue rather than piling up behind each other in the serial driver's buffer
+    def _writer_loop(self):
+        next_write = time.monotonic()
+        while True:
+            delay = next_write - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            batch = self._queue.get(self.WRITE_CHUNK)
+            if batch is None:
                 break
-            if c == b'\n':
-                self._on_message(buf.decode('ascii'))
-                buf = b''
+            data = b''.join(cmd for priority, t, cmd in batch)
+            if self.metrics is not None:
+                now = time.perf_counter()
+                for priority, t, cmd in batch:
+                    self._queue_wait_time[priority].observe(now - t)
+            try:
+                self._write(data)
+            except ConnectionError:
+                pass
+            except Exception as e:
+                logger.error("Error writing to %s on %s: %s" % (type(self).__name__, self.port, e))
+            next_write = max(next_write, time.monotonic()) + 10 * len(data) / self.BAUDRATE
+
+    def _write(self, data):
+        t0 = None if self.metrics is None else time.perf_counter()
+        with self._write_lock:
+            if self.recorder is not None:
+                self.recorder.record_output(data)
+            try:
+                self._ser.write(data)
+            # pyserial raises TypeError when another thread closes the port during a write
+            except (serial.SerialException, OSError, TypeError) as e:
+                error = e
             else:
-                buf += c
-        logger.info("Exited listen loop")
+                error = None
+        if error is not None:
+            # Closing the port makes the reader notice too, so it reconnects
+            if self.connected and not self._closing.is_set():
+                logger.error("Error writing to %s on %s: %s" % (type(self).__name__, self.port, error))
+                self._drop_link()
+                self._on_disconnected(error)
+            raise ConnectionError("%s on %s is disconnected: %s" % (type(self).__name__, self.port, error))
+        if t0 is not None:
+            self._write_time.observe(time.perf_counter() - t0)
+
+    def _reopen(self):
+        if not isinstance(self.port, str):
+            raise ValueError("Cannot reopen %s connection that was not opened by port name" % type(self).__name__)
+        try:
+            self._ser.close()
+        except Exception:
+            pass
+        ser = serial.Serial(self.port, baudrate=self.BAUDRATE)
+        with self._write_lock:
+            self._ser = ser
+        self._in_buf = bytearray()
+
+    def _load_state(self, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            logger.warning("Ignoring unreadable panel state in %s: %s" % (path, e))
+            return False
+        if data.get('panel') != type(self).__name__:
+            logger.warning("Ignoring panel state in %s saved for %s" % (path, data.get('panel')))
+            return False
+        for switch, value in data.get('switches', {}).items():
+            slot = self._switch_slot.get(switch)
+            if slot is not None:
+                self._switch_known |= 1 << slot
+                if value:
+                    self._switch_bits |= 1 << slot
+        for analog, value in data.get('analogs', {}).items():
+            slot = self._analog_slot.get(analog)
+            if slot is not None:
+                self._analog_known |= 1 << slot
+                self._analog_values[slot] = min(max(int(value), 0), self.ANALOG_RANGE - 1)
+        return True
+
+    @classmethod
+    def _slot_names(cls):
+        names = cls.__dict__.get('_SLOT_NAMES')
+        if names is None:
+            names = cls._SLOT_NAMES = (tuple(sorted(cls.SWITCHES)), tuple(sorted(cls.ANALOGS)))
+        return names
+
+    @classmethod
+    def _slots(cls):
+        slots = cls.__dict__.get('_SLOTS')
+        if slots is None:
+            slots = cls._SLOTS = tuple({name: slot for slot, name in enumerate(names)}
+                                       for names in cls._slot_names())
+        return slots
+
+    @classmethod
+    def _decode_table(cls):
+        table = cls.__dict__.get('_DECODE_TABLE')
+        if table is None:
+            switch_slot, analog_slot = cls._slots()
+            table = {b'*READY': (cls.READY_KEY, None)}
+            for switch in cls.SWITCHES:
+                key = sys.intern(cls.SWITCH_PREFIX + switch)
+                slot = switch_slot[switch]
+                table[('S%sD' % switch).encode('ascii')] = (key, True, cls.SWITCH_KIND, switch, slot)
+                table[('S%sU' % switch).encode('ascii')] = (key, False, cls.SWITCH_KIND, switch, slot)
+            base = len(cls.ANALOG_DIGITS)
+            for analog in cls.ANALOGS:
+                key = sys.intern(cls.ANALOG_PREFIX + analog)
+                slot = analog_slot[analog]
+                for i, hi in enumerate(cls.ANALOG_DIGITS):
+                    for j, lo in enumerate(cls.ANALOG_DIGITS):
+                        table[('A%s%s%s' % (analog, hi, lo)).encode('ascii')] = (
+                            key, i * base + j, cls.ANALOG_KIND, analog, slot)
+            cls._DECODE_TABLE = table
+        return table
+
+    def _on_lines(self, lines):
+        table = self._decode_table()
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for line in lines:
+            decoded = table.get(line)
+            if decoded is not None:
+                if debug:
+                    logger.debug("Incoming: %s", line.decode('ascii'))
+                self._update_value(*decoded)
+            elif line:
+                self._on_message(line.decode('ascii', 'replace'))
 
     def _on_message(self, msg):
-        logger.debug("Incoming: " + msg)
+        decoded = self._decode_message(msg)
+        if decoded is not None:
+            self._update_value(*decoded)
+
+    @classmethod
+    def _decode_message(cls, msg):
+        logger.debug("Incoming: %s", msg)
         if msg[0] == 'S':
             switch = msg[1:3]
-            if switch not in self.SWITCHES:
-                logger.error("Received event '%s' for unknown switch %s in %s" % (msg, switch, type(self).__name__))
-                return
-            value = msg[3] == 'D'
-            self._update_value(self._switch_key(switch), value)
+            if switch not in cls.SWITCHES:
+                logger.error("Received event '%s' for unknown switch %s in %s" % (msg, switch, cls.__name__))
+                return None
+            return cls._switch_key(switch), msg[3] == 'D', cls.SWITCH_KIND, switch, cls._slots()[0][switch]
         elif msg[0] == 'A':
             analog = msg[1]
-            if analog not in self.ANALOGS:
-                logger.error("Received event '%s' for unknown analog input %s in %s" % (msg, analog, type(self).__name__))
-                return
-            value = self.ANALOG_DIGITS.find(msg[2]) * len(self.ANALOG_DIGITS) + self.ANALOG_DIGITS.find(msg[3])
-            self._update_value(self._analog_key(analog), value)
+            if analog not in cls.ANALOGS:
+                logger.error("Received event '%s' for unknown analog input %s in %s" % (msg, analog, cls.__name__))
+                return None
+            value = cls.ANALOG_DIGITS.find(msg[2]) * len(cls.ANALOG_DIGITS) + cls.ANALOG_DIGITS.find(msg[3])
+            return cls._analog_key(analog), value, cls.ANALOG_KIND, analog, cls._slots()[1][analog]
         elif msg == '*READY':
-            self._update_value(self.READY_KEY, None)
+            return cls.READY_KEY, None
+        elif msg.startswith('*PID'):
+            return cls.ID_KEY, msg[4:]
         elif msg.startswith('*'):
             logger.warning(msg)
         else:
             logger.error("Unexpected incoming message: " + msg)
+        return None
+
+    @classmethod
+    def _switch_key(cls, switch):
+        return cls.SWITCH_PREFIX + switch
+
+    @classmethod
+    def _analog_key(cls, analog):
+        return cls.ANALOG_PREFIX + analog
+
+    # Precomputes the output target and command prefix of every indicator and servo, the
+    # suffixes for binary and color values, and the encoding of every servo position
+    @classmethod
+    def _compile_encoders(cls):
+        cls._BINARY_INDICATORS = {
+            indicator: (sys.intern('S' + indicator), ('S' + indicator).encode('ascii'))
+            for indicator in cls.BINARY_INDICATORS}
+        cls._COLORED_LEDS = {
+            led: (sys.intern('S' + led), ('S' + led).encode('ascii'))
+            for led in cls.COLORED_LEDS}
+        cls._COLOR_SUFFIXES = {}
+        for color in cls.COLORS:
+            cls._COLOR_SUFFIXES[color] = cls._COLOR_SUFFIXES[str(color)] = ('%d\n' % color).encode('ascii')
+        cls._SERVOS = {
+            servo: (sys.intern('T' + servo), ('T' + servo).encode('ascii'))
+            for servo in cls.SERVOS}
+        cls._SERVO_POSITIONS = tuple(
+            (cls.SERVO_DIGITS[value // cls.SERVO_BASE] + cls.SERVO_DIGITS[value % cls.SERVO_BASE] + '\n').encode('ascii')
+            for value in range(cls.SERVO_MAX + 1))
+
+    @classmethod
+    def _indicator_command(cls, indicator, value):
+        encoder = cls._BINARY_INDICATORS.get(indicator)
+        if encoder is not None:
+            return encoder[0], encoder[1] + (b'1\n' if value else b'0\n')
+        encoder = cls._COLORED_LEDS.get(indicator)
+        if encoder is None:
+            raise ValueError("Indicator '%s' does not exist in %s" % (indicator, cls.__name__))
+        suffix = cls._COLOR_SUFFIXES.get(value)
+        if suffix is None:
+            suffix = ('%s\n' % value).encode('ascii')
+        return encoder[0], encoder[1] + suffix
 
-    def _switch_key(self, switch):
-        return self.SWITCH_PREFIX + switch
+    @classmethod
+    def _servo_command(cls, servo, value):
+        encoder = cls._SERVOS.get(servo)
+        if encoder is None:
+            raise ValueError("Servo '%s' does not exist in %s" % (servo, cls.__name__))
+        if value < 0 or value > cls.SERVO_MAX:
+            raise ValueError("Servo value %g is outside the range [0, %d]" % (value, cls.SERVO_MAX))
+        return encoder[0], encoder[1] + cls._SERVO_POSITIONS[round(value)]
 
-    def _analog_key(self, analog):
-        return self.ANALOG_PREFIX + analog
+    # Positions at which the rounded servo value changes, sampled no faster than the link can
+    # carry one servo command
+    def _servo_trajectory(self, servo, start, target, duration, curve, interval):
+        steps = []
+        last = round(start)
+        n = max(1, int(duration / interval))
+        for i in range(1, n + 1):
+            position = min(max(round(start + (target - start) * curve(i / n)), 0), self.SERVO_MAX)
+            if position != last:
+                steps.append((duration * i / n, position, self._servo_command(servo, position)[1]))
+                last = position
+        if last != round(target):
+            steps.append((duration, round(target), self._servo_command(servo, target)[1]))
+        return steps
 
-    def _update_value(self, key, value):
+    def _motion_loop(self):
+        with self._motion_changed:
+            try:
+                while self._motions:
+                    now = time.monotonic()
+                    due = None
+                    outputs = {}
+                    for servo, motion in list(self._motions.items()):
+                        start, target, steps, i = motion
+                        n = i
+                        while n < len(steps) and start + steps[n][0] <= now:
+                            n += 1
+                        if n > i:
+                            self._servo_positions[servo] = steps[n - 1][1]
+                            outputs[target] = steps[n - 1][2]
+                            motion[3] = n
+                        if n == len(steps):
+                            del self._motions[servo]
+                        elif due is None or start + steps[n][0] < due:
+                            due = start + steps[n][0]
+                    if outputs:
+                        with self._lock:
+                            self._outputs.update(outputs)
+                            for target in outputs:
+                                self._pending_outputs.pop(target, None)
+                        self._send_outputs(outputs)
+                    if due is not None:
+                        self._motion_changed.wait(due - time.monotonic())
+            except Exception:
+                logger.exception("Error moving servos on %s on %s" % (type(self).__name__, self.port))
+            finally:
+                self._motions.clear()
+                self._motion_thread = None
+
+    def _set_output(self, target, cmd):
         with self._lock:
-            events = self._value_events.pop(key, [])
-            self._changed_keys.add(key)
-        self._values[key] = value
-        for event in events:
-            event.set()
-
-    def _get_value(self, key, cmd):
-        response_received = threading.Event()
+            if self._outputs.get(target) == cmd:
+                self._pending_outputs.pop(target, None)
+            else:
+                self._pending_outputs[target] = cmd
+        if self.autoflush:
+            self.flush()
+
+    def _update_value(self, key, value, kind=None, name=None, slot=None):
         with self._lock:
-            events = self._value_events.get(key, [])
-            events.append(response_received)
-            self._value_events[key] = events
-        self.send_command(cmd)
-        response_received.wait()
-        return self._values[key]
-
-    def _changed_values(self, prefix):
-        changed = []
+            pending = self._value_futures.pop(key, ())
+            changed = False
+            if kind == self.SWITCH_KIND:
+                bit = 1 << slot
+                changed = not self._switch_known & bit or (self._switch_bits & bit != 0) != value
+                self._switch_known |= bit
+                if value:
+                    self._switch_bits |= bit
+                else:
+                    self._switch_bits &= ~bit
+            elif kind == self.ANALOG_KIND:
+                bit = 1 << slot
+                changed = not self._analog_known & bit or self._analog_values[slot] != value
+                self._analog_known |= bit
+                analog_filter = self._analog_filters.get(name)
+                if analog_filter is not None:
+                    changed = analog_filter.update(value, time.monotonic())
+                    value = analog_filter.value
+                    self._schedule_filter_flush(analog_filter.due())
+                self._analog_values[slot] = value
+            if changed:
+                self._changes[kind][name] = None
+                self._changed.notify_all()
+        for future in pending:
+            _resolve(future, value)
+        if changed:
+            self._notify(Change(kind, name, value, time.monotonic()))
+
+    def _notify(self, change):
+        for callback in self._subscribers:
+            try:
+                callback(change)
+            except Exception as e:
+                logger.error("Error in change subscriber %s: %s" % (callback, e))
+
+    # Called with self._lock held; arms a single timer for the earliest analog filter flush
+    def _schedule_filter_flush(self, due):
+        if due is None or (self._filter_due is not None and self._filter_due <= due) or self._closing.is_set():
+            return
+        if self._filter_timer is not None:
+            self._filter_timer.cancel()
+        self._filter_due = due
+        self._filter_timer = threading.Timer(max(0, due - time.monotonic()), self._flush_filters)
+        self._filter_timer.daemon = True
+        self._filter_timer.start()
+
+    def _flush_filters(self):
+        reported = []
         with self._lock:
-            for key in list(self._changed_keys):
-                if key.startswith(prefix):
-                    changed.append(key[len(prefix):])
-                    self._changed_keys.remove(key)
-        return changed
+            self._filter_timer = None
+            self._filter_due = None
+            now = time.monotonic()
+            for name, analog_filter in self._analog_filters.items():
+                due = analog_filter.due()
+                if due is not None and due <= now:
+                    if analog_filter.flush(now):
+                        self._changes[self.ANALOG_KIND][name] = None
+                        reported.append(Change(self.ANALOG_KIND, name, analog_filter.value, now))
+                    self._analog_values[self._analog_slot[name]] = analog_filter.value
+                self._schedule_filter_flush(analog_filter.due())
+            if reported:
+                self._changed.notify_all()
+        for change in reported:
+            self._notify(change)
+
+    def _query_values(self, requests, timeout=None):
+        pending = []
+        t = time.perf_counter()
+        deadline = t + (self.QUERY_TIMEOUT if timeout is None else timeout)
+        with self._lock:
+            for key, cmd in requests:
+                future = futures.Future()
+                future.key = key
+                future.cmd = cmd
+                future.sent = t
+                future.deadline = deadline
+                self._value_futures.setdefault(key, []).append(future)
+                pending.append(future)
+        if requests:
+            try:
+                self.send_commands([cmd for key, cmd in requests])
+            except ConnectionError as e:
+                self._forget_values(pending)
+                for future in pending:
+                    _resolve(future, error=e)
+        return pending
 
+    def _forget_values(self, pending):
+        with self._lock:
+            for future in pending:
+                waiting = self._value_futures.get(future.key, [])
+                if future in waiting:
+                    waiting.remove(future)
+                    if not waiting:
+                        del self._value_futures[future.key]
+
+    def _wait_values(self, pending, timeout=None):
+        if timeout is None:
+            timeout = self.QUERY_TIMEOUT
+        not_done = futures.wait(pending, timeout).not_done
+        if not_done:
+            self._forget_values(not_done)
+            for future in not_done:
+                future.cancel()
+            raise TimeoutError("No response to %s from %s within %gs" % (
+                ', '.join(sorted(f.cmd for f in not_done)), type(self).__name__, timeout))
+        if self.metrics is not None and pending:
+            self._query_time.observe(time.perf_counter() - pending[0].sent)
+        return [future.result() for future in pending]
 
-class PanelA(Panel):
-    SWITCHES = {'B0', 'B1', 'B2', 'G0', 'G1', 'G2', 'R0', 'R1', 'R2', 'Q0', 'Q1', 'Q2', 'Q3', 'A0', 'S0', 'S1'}
-    BINARY_INDICATORS = {'B0', 'B1', 'B2', 'G0', 'G1', 'G2', 'R0', 'R1', 'R2', 'A0', 'S0', 'S1'}
-    COLORED_LEDS = {'Q0', 'Q1', 'Q2', 'Q3'}
-    ANALOGS = {'0'}
-    SERVOS = {'0'}
+    def _get_value(self, key, cmd, timeout=None):
+        return self._wait_values(self._query_values(((key, cmd),), timeout), timeout)[0]
+
+    def _pop_changes(self, kind, timeout=0):
+        with self._changed:
+            changes = self._changes[kind]
+            if not changes and timeout != 0:
+                self._changed.wait_for(lambda: changes, timeout)
+            changed = list(changes)
+            changes.clear()
+        return changed
 
 
-class PanelB(Panel):
-    SWITCHES = {'LR', 'LY', 'LG', 'RR', 'RY', 'RG', 'JU', 'JR', 'JD', 'JL', '00', '01', '02', '10', '11', '12', '20', '21', '22'}
-    BINARY_INDICATORS = {'LR', 'LY', 'LG', 'RR', 'RY', 'RG', 'JC', '00', '01', '02', '10', '11', '12', '20', '21', '22'}
+PanelA = Panel.from_layout('PanelA')
+PanelB = Panel.from_layout('PanelB')
@@ -0,0 +1,293 @@
+import argparse
+import importlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import panels
+from dmx import CHANNELS, SPAN_HEADER, changed_spans, encode_spans
+from scheduler import default_scheduler
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+MAGIC = b'PNLREC\x00\x01'
+RECORD_HEADER = struct.Struct('<dBI')
+INPUT = 1
+OUTPUT = 2
+DMX_SPANS = 3
+KIND_NAMES = {INPUT: 'input', OUTPUT: 'output', DMX_SPANS: 'dmx'}
+FILE_SIZE = 16 * 1024 * 1024
+FILE_COUNT = 4
+REPLAY_STALL = 0.1
+HEARTBEAT_QUERY = b'*RID'
+
+
+# Appends timestamped records to a preallocated, memory-mapped file, rotating through
+# `files` files of `size` bytes each; `path` is the newest and `path.1` the next oldest
+class Recorder(object):
+    def __init__(self, path, size=FILE_SIZE, files=FILE_COUNT):
+        if size <= len(MAGIC) + RECORD_HEADER.size:
+            raise ValueError("Recording file size %d is too small" % size)
+        self.path = path
+        self.size = size
+        self.files = files
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._offset = 0
+        self._frame = None
+        self._open()
+
+    def record_input(self, data):
+        self._record(INPUT, data)
+
+    def record_output(self, data):
+        self._record(OUTPUT, data)
+
+    def record_frame(self, frame):
+        # Frames are stored as the spans that changed since the previous recorded frame. Each file
+        # starts from a blank universe, so rotating first when the record will not fit keeps every
+        # file readable without the older files that rotation deletes.
+        with self._lock:
+            if self._map is None:
+                return
+            spans = changed_spans(self._frame, frame)
+            if spans and self._offset + RECORD_HEADER.size + len(encode_spans(frame, spans)) > self.size:
+                self._rotate()
+                spans = changed_spans(self._frame, frame)
+            self._frame = bytes(frame)
+            if spans:
+                self._append(DMX_SPANS, encode_spans(frame, spans))
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _record(self, kind, data):
+        with self._lock:
+            if self._map is None:
+                return
+            self._append(kind, data)
+
+    def _append(self, kind, data):
+        n = RECORD_HEADER.size + len(data)
+        end = self._offset + n
+        if end > self.size:
+            if len(MAGIC) + n > self.size:
+                raise ValueError("Record of %d bytes does not fit in a %d-byte recording file" % (n, self.size))
+            self._rotate()
+            end = self._offset + n
+        RECORD_HEADER.pack_into(self._map, self._offset, time.monotonic(), kind, len(data))
+        self._map[self._offset + RECORD_HEADER.size:end] = data
+        self._offset = end
+        self.records += 1
+
+    def _open(self):
+        if os.path.exists(self.path):
+            self._shift()
+        self._file = open(self.path, 'w+b')
+        self._file.truncate(self.size)
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+        self._map[:len(MAGIC)] = MAGIC
+        self._offset = len(MAGIC)
+        self._frame = bytes(CHANNELS)
+
+    def _close(self):
+        if self._map is None:
+            return
+        self._map.close()
+        self._map = None
+        self._file.truncate(self._offset)
+        self._file.close()
+
+    def _rotate(self):
+        self._close()
+        self._open()
+
+    def _shift(self):
+        for i in range(self.files - 1, 0, -1):
+            older = '%s.%d' % (self.path, i)
+            newer = self.path if i == 1 else '%s.%d' % (self.path, i - 1)
+            if os.path.exists(newer):
+                os.replace(newer, older)
+        if self.files <= 1 and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __del__(self):
+        self.close()
+
+
+def recording_files(path):
+    files = [path]
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        files.append('%s.%d' % (path, i))
+        i += 1
+    return [f for f in reversed(files) if os.path.exists(f)]
+
+
+def read_records(path):
+    for filename in recording_files(path):
+        for record in read_file_records(filename):
+            yield record
+
+
+def read_file_records(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a panel recording" % filename)
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        t, kind, n = RECORD_HEADER.unpack_from(data, offset)
+        if kind == 0:
+            break
+        offset += RECORD_HEADER.size
+        yield t, kind, data[offset:offset + n]
+        offset += n
+
+
+def read_frames(path):
+    for filename in recording_files(path):
+        # Each file's frames are relative to a blank universe
+        frame = bytearray(CHANNELS)
+        for t, kind, data in read_file_records(filename):
+            if kind != DMX_SPANS:
+                continue
+            offset = 0
+            while offset < len(data):
+                start, n = SPAN_HEADER.unpack_from(data, offset)
+                offset += SPAN_HEADER.size
+                frame[start:start + n] = data[offset:offset + n]
+                offset += n
+            yield t, bytes(frame)
+
+
+# Counts the commands a replayed panel sends and waits for replies to. Heartbeat queries are left
+# out: a replayed panel runs without a heartbeat, so it never sends them, and their *PID replies
+# need no query to have been sent.
+def count_queries(data):
+    return sum(1 for line in data.split(b'\n') if line[:1] in (b'Q', b'*') and line != HEARTBEAT_QUERY)
+
+
+# Stands in for a panel's serial port, delivering recorded input either in real time or as
+# fast as possible. Input that followed a query in the recording is held back until the
+# replayed application has sent as many queries, so replies never overtake their queries.
+class ReplaySerial(object):
+    def __init__(self, path, realtime=True, speed=1.0):
+        self.realtime = realtime
+        self.speed = speed
+        self.written = 0
+        self.queries = 0
+        self.finished = threading.Event()
+        self._inputs = []
+        self._t0 = None
+        queries = 0
+        for t, kind, data in read_records(path):
+            if self._t0 is None:
+                self._t0 = t
+            if kind == INPUT:
+                self._inputs.append((t - self._t0, queries, data))
+            elif kind == OUTPUT:
+                queries += count_queries(data)
+        self._next = 0
+        self._time = 0
+        self._start = time.monotonic()
+        self._written = threading.Condition()
+        self._closed = False
+
+    # Recording-relative time of the most recently delivered input
+    def clock(self):
+        if self.realtime:
+            return (time.monotonic() - self._start) * self.speed
+        return self._time
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        if self._closed or self._next >= len(self._inputs):
+            self.finished.set()
+            raise IOError("End of recording")
+        t, queries, data = self._inputs[self._next]
+        with self._written:
+            self._written.wait_for(lambda: self.queries >= queries or self._closed, REPLAY_STALL)
+        if self.realtime:
+            delay = self._start + t / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self._next += 1
+        self._time = t
+        return data
+
+    def write(self, data):
+        queries = count_queries(data)
+        with self._written:
+            self.written += len(data)
+            if queries:
+                self.queries += queries
+                self._written.notify_all()
+        return len(data)
+
+    def close(self):
+        with self._written:
+            self._closed = True
+            self._written.notify_all()
+
+
+def replay(path, launcher, realtime=True, speed=1.0):
+    serial = ReplaySerial(path, realtime, speed)
+    clock = default_scheduler.clock
+    default_scheduler.clock = serial.clock
+    try:
+        panel = launcher.PANEL(serial, autoflush=False)
+        system = launcher.create_system(panel)
+        t0 = time.perf_counter()
+        steps = 0
+        while True:
+            finished = serial.finished.is_set()
+            launcher.step(panel, system, 0 if finished else REPLAY_STALL)
+            steps += 1
+            if finished:
+                break
+        dt = time.perf_counter() - t0
+    finally:
+        default_scheduler.clock = clock
+    logger.info("Replayed %d inputs in %.3fs (%d steps, %d command bytes written)" % (
+        len(serial._inputs), dt, steps, serial.written))
+    return panel, system
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or replay a panel recording')
+    parser.add_argument('recording', help='Recording file')
+    parser.add_argument('--launcher', help='Launcher module to replay the recording through, e.g. PanelALauncher')
+    parser.add_argument('--fast', action='store_true', help='Replay as fast as possible instead of in real time')
+    parser.add_argument('--speed', type=float, default=1.0, help='Real-time replay speed multiplier')
+    args = parser.parse_args()
+
+    if args.launcher is None:
+        counts = {}
+        t_first = t_last = None
+        for t, kind, data in read_records(args.recording):
+            counts[kind] = counts.get(kind, 0) + 1
+            t_first = t if t_first is None else t_first
+            t_last = t
+        duration = 0 if t_first is None else t_last - t_first
+        logger.info("%s: %.3fs, %s" % (args.recording, duration, ', '.join(
+            '%d %s records' % (counts[k], KIND_NAMES.get(k, k)) for k in sorted(counts))))
+        return
+
+    panels.logger.setLevel(logging.WARNING)
+    replay(args.recording, importlib.import_module(args.launcher), not args.fast, args.speed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer(object):
+    __slots__ = ('due', 'callback', 'cancelled')
+
+    def __init__(self, due, callback):
+        self.due = due
+        self.callback = callback
+        self.cancelled = False
+
+
+class Scheduler(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def call_at(self, due, callback):
+        timer = Timer(due, callback)
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._seq), timer))
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(self.clock() + delay, callback)
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer.cancelled = True
+
+    def next_due(self):
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def timeout(self, max_timeout=None):
+        due = self.next_due()
+        if due is None:
+            return max_timeout
+        timeout = max(0, due - self.clock())
+        return timeout if max_timeout is None else min(timeout, max_timeout)
+
+    def run_pending(self):
+        now = self.clock()
+        count = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                timer = heapq.heappop(self._heap)[2]
+            if not timer.cancelled:
+                timer.cancelled = True
+                timer.callback()
+                count += 1
+        return count
+
+
+default_scheduler = Scheduler()
@@ -1,25 +1,43 @@
-import datetime
+from scheduler import default_scheduler
+
+
+UPDATE_INTERVAL = 0.02
 
 
 class Scroller(object):
-    def __init__(self, min_value, max_value, speed=None):
+    def __init__(self, min_value, max_value, speed=None, on_change=None, scheduler=None, interval=UPDATE_INTERVAL):
         self.min_value = min_value
         self.max_value = max_value
         self._value = min_value
         self._scroll_speed = (max_value - min_value) / 10 if speed is None else speed
         self._scroll_start = None
         self._scroll_direction = 0
+        self._on_change = on_change
+        self._scheduler = default_scheduler if scheduler is None else scheduler
+        self._interval = interval
+        self._timer = None
 
     def _value_at(self, t):
         if self._scroll_direction == 0:
             return self._value
-        dv = (t - self._scroll_start).total_seconds() * self._scroll_speed * self._scroll_direction
+        dv = (t - self._scroll_start) * self._scroll_speed * self._scroll_direction
         return min(max(self._value + dv, self.min_value), self.max_value)
 
     def _finish_scroll(self, t):
         if self._scroll_direction != 0:
             self._value = self._value_at(t)
 
+    def _changed(self):
+        if self._on_change is None:
+            return
+        value = self.get_value()
+        self._on_change(value)
+        self._scheduler.cancel(self._timer)
+        self._timer = None
+        if (self._scroll_direction > 0 and value < self.max_value or
+                self._scroll_direction < 0 and value > self.min_value):
+            self._timer = self._scheduler.call_later(self._interval, self._changed)
+
     def scroll_down(self, scroll=True):
         self.scroll(-1, scroll)
 
@@ -28,27 +46,30 @@ class Scroller(object):
 
     def scroll(self, direction, scroll=True):
         if scroll:
-            now = datetime.datetime.utcnow()
+            now = self._scheduler.clock()
             self._finish_scroll(now)
             self._scroll_start = now
             self._scroll_direction = direction
+            self._changed()
         else:
             self.scroll_stop()
 
     def scroll_stop(self):
-        now = datetime.datetime.utcnow()
+        now = self._scheduler.clock()
         self._finish_scroll(now)
         self._scroll_start = None
         self._scroll_direction = 0
+        self._changed()
 
     def get_value(self):
         if self._scroll_direction == 0:
             return self._value
-        return self._value_at(datetime.datetime.utcnow())
+        return self._value_at(self._scheduler.clock())
 
     def set_value(self, value):
         self._value = value
-        self._scroll_start = datetime.datetime.utcnow()
+        self._scroll_start = self._scheduler.clock()
+        self._changed()
 
     value = property(get_value, set_value)
 
@@ -56,9 +77,10 @@ class Scroller(object):
         return self._scroll_speed
 
     def set_speed(self, speed):
-        now = datetime.datetime.utcnow()
+        now = self._scheduler.clock()
         self._value = self._value_at(now)
         self._scroll_start = now
         self._scroll_speed = speed
+        self._changed()
 
     speed = property(get_speed, set_speed)
@@ -0,0 +1,221 @@
+import argparse
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+import panels
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+READ_POLL = 0.1
+# The firmware sends a 10-bit analog reading as two digits in base SLIDER_BASE (PanelA.ino),
+# independently of the base the host decodes them with
+FIRMWARE_ANALOG_BASE = 32
+FIRMWARE_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+# Emulates a panel's Arduino firmware on the master side of a pseudo-terminal;
+# a Panel opens the slave side through `port` exactly as it would a USB serial device.
+# With `boot_delay`, commands are ignored and READY is held back for that long, as while
+# the bootloader runs after the host opens the port and resets the board. With `baudrate`,
+# commands are read no faster than a serial link of that speed delivers them.
+class PanelSimulator(object):
+    def __init__(self, layout, link=None, boot_delay=0, baudrate=None):
+        self.layout = layout
+        self.switches = dict.fromkeys(layout.SWITCHES, False)
+        self.analogs = dict.fromkeys(layout.ANALOGS, 0)
+        self.push_analogs = dict.fromkeys(layout.ANALOGS, False)
+        self.indicators = {}
+        self.servos = {}
+        self.commands = 0
+        self.errors = 0
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._closed = False
+        self._booted_at = time.monotonic() + boot_delay
+        self.baudrate = baudrate
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.link = link
+        if link is None:
+            self.port = os.ttyname(self._slave)
+        else:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.ttyname(self._slave), link)
+            self.port = link
+        t = threading.Thread(target=self._read_loop)
+        t.daemon = True
+        t.start()
+        if boot_delay > 0:
+            t = threading.Timer(boot_delay, self._boot)
+            t.daemon = True
+            t.start()
+        else:
+            self.send(('*READY',))
+
+    # The reader only touches the pty under the same locks, so it can never read from or write to
+    # a descriptor number that a later simulator has been given after this one closed its own
+    def close(self):
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+        with self._read_lock, self._write_lock:
+            if self._closed:
+                return
+            self._closed = True
+            os.close(self._master)
+            os.close(self._slave)
+
+    def _boot(self):
+        try:
+            self.send(('*READY',))
+        except OSError:
+            pass
+
+    def send(self, lines):
+        data = ''.join(line + '\n' for line in lines).encode('ascii')
+        with self._write_lock:
+            if self._closed:
+                raise OSError("%s simulator is closed" % self.layout.__name__)
+            os.write(self._master, data)
+
+    def set_switch(self, switch, down):
+        self.switches[switch] = down
+        self.send((self._switch_message(switch),))
+
+    def set_analog(self, analog, value):
+        self.analogs[analog] = value
+        if self.push_analogs[analog]:
+            self.send((self._analog_message(analog),))
+
+    # Sends `count` random switch and analog updates, paced at `rate` messages per second
+    # when given, and returns the number of messages sent
+    def storm(self, count, rate=None, analog_fraction=0.5, batch=64, seed=0):
+        switches = sorted(self.switches)
+        analogs = sorted(self.analogs)
+        rnd = random.Random(seed)
+        t0 = time.monotonic()
+        sent = 0
+        while sent < count:
+            lines = []
+            for _ in range(min(batch, count - sent)):
+                if analogs and rnd.random() < analog_fraction:
+                    analog = rnd.choice(analogs)
+                    self.analogs[analog] = rnd.randrange(FIRMWARE_ANALOG_BASE ** 2)
+                    lines.append(self._analog_message(analog))
+                else:
+                    switch = rnd.choice(switches)
+                    self.switches[switch] = not self.switches[switch]
+                    lines.append(self._switch_message(switch))
+            self.send(lines)
+            sent += len(lines)
+            if rate is not None:
+                delay = t0 + sent / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        return sent
+
+    def _switch_message(self, switch):
+        return 'S%s%s' % (switch, 'D' if self.switches[switch] else 'U')
+
+    def _analog_message(self, analog):
+        hi, lo = divmod(self.analogs[analog], FIRMWARE_ANALOG_BASE)
+        return 'A%s%s%s' % (analog, FIRMWARE_DIGITS[hi], FIRMWARE_DIGITS[lo])
+
+    def _read_loop(self):
+        buf = bytearray()
+        while True:
+            try:
+                ready = select.select([self._master], [], [], READ_POLL)[0]
+                with self._read_lock:
+                    if self._closed:
+                        break
+                    if not ready:
+                        continue
+                    chunk = os.read(self._master, 4096 if self.baudrate is None else 16)
+            except (OSError, ValueError):
+                break
+            if not chunk:
+                break
+            if self.baudrate is not None:
+                time.sleep(10 * len(chunk) / self.baudrate)
+            if time.monotonic() < self._booted_at:
+                continue
+            buf += chunk
+            end = buf.rfind(b'\n')
+            if end < 0:
+                continue
+            replies = []
+            for cmd in bytes(buf[:end]).decode('ascii', 'replace').split('\n'):
+                reply = self._on_command(cmd.rstrip('\r'))
+                if reply is not None:
+                    replies.append(reply)
+            del buf[:end + 1]
+            if replies:
+                try:
+                    self.send(replies)
+                except OSError:
+                    break
+
+    def _on_command(self, cmd):
+        self.commands += 1
+        if cmd in ('*READY', '*ANI'):
+            return '*READY' if cmd == '*READY' else None
+        elif cmd == '*RID':
+            return '*PID' + self.layout.__name__
+        elif cmd.startswith('PA') and cmd[2:3] in self.analogs:
+            self.push_analogs[cmd[2:3]] = cmd[3:4] not in ('', '0')
+        elif cmd.startswith('QS') and cmd[2:4] in self.switches:
+            return self._switch_message(cmd[2:4])
+        elif cmd.startswith('QA') and cmd[2:3] in self.analogs:
+            return self._analog_message(cmd[2:3])
+        elif cmd.startswith('S') and (cmd[1:3] in self.layout.BINARY_INDICATORS or
+                                      cmd[1:3] in self.layout.COLORED_LEDS):
+            self.indicators[cmd[1:3]] = cmd[3:]
+        elif cmd.startswith('T') and cmd[1:2] in self.layout.SERVOS:
+            digits = self.layout.SERVO_DIGITS
+            self.servos[cmd[1:2]] = digits.index(cmd[2]) * self.layout.SERVO_BASE + digits.index(cmd[3])
+        elif cmd:
+            self.errors += 1
+            return "*ERR Could not parse '%s'" % cmd
+        return None
+
+
+def main():
+    layouts = {'PanelA': panels.PanelA, 'PanelB': panels.PanelB}
+    parser = argparse.ArgumentParser(description='Simulate panel firmware on a pseudo-terminal')
+    parser.add_argument('layout', help='Panel to simulate: %s or a layout file' % ', '.join(sorted(layouts)))
+    parser.add_argument('--link', help='Symlink to create for the simulated serial port')
+    parser.add_argument('--storm', type=float, default=0, help='Random input updates per second')
+    parser.add_argument('--analog-fraction', type=float, default=0.5,
+                        help='Fraction of storm updates that are analog samples')
+    args = parser.parse_args()
+    if args.layout in layouts:
+        layout = layouts[args.layout]
+    elif args.layout.endswith('.json'):
+        layout = panels.Panel.from_layout(args.layout)
+    else:
+        parser.error("Unknown layout '%s'" % args.layout)
+
+    sim = PanelSimulator(layout, args.link)
+    logger.info("Simulating %s on %s" % (args.layout, sim.port))
+    try:
+        while True:
+            if args.storm > 0:
+                sim.storm(int(args.storm), args.storm, args.analog_fraction, seed=None)
+            else:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+from concurrent import futures
+import logging
+import threading
+import time
+from dmx import DmxClient, FRAME_RATE, SEND_TIMEOUT, frame_start, next_frame_time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+SEND_WORKERS = 4
+
+
+# Owns one DmxClient buffer per universe and sends every changed universe on a shared frame
+# boundary through a pool of sender threads. A universe whose previous frame is still in
+# flight skips the boundary, so a slow server only delays its own universe.
+class UniverseManager(object):
+    def __init__(self, universes, encoding='hex', timeout=SEND_TIMEOUT, frame_rate=FRAME_RATE,
+                 workers=SEND_WORKERS, metrics=None):
+        self.frame_rate = frame_rate
+        self.workers = workers
+        self.universes = {}
+        self._dirty = threading.Event()
+        self._lock = threading.Lock()
+        self._active = False
+        self._stopping = threading.Event()
+        self._complete = threading.Event()
+        self._pool = None
+        self._sending = {}
+        for universe, base_url in universes.items():
+            client = DmxClient(base_url, encoding, timeout, frame_rate, metrics=metrics)
+            client._on_dirty = self._dirty.set
+            self.universes[universe] = client
+
+    def universe(self, universe):
+        client = self.universes.get(universe)
+        if client is None:
+            raise ValueError("DMX universe %s does not exist" % (universe,))
+        return client
+
+    def __getitem__(self, key):
+        universe, channel = key
+        return self.universe(universe)[channel]
+
+    def __setitem__(self, key, value):
+        universe, channel = key
+        self.universe(universe)[channel] = value
+
+    def set_range(self, universe, start, values):
+        self.universe(universe).set_range(start, values)
+
+    def start(self):
+        with self._lock:
+            if self._active:
+                return
+            self._active = True
+            self._stopping = threading.Event()
+            self._complete = threading.Event()
+            self._pool = futures.ThreadPoolExecutor(self.workers, thread_name_prefix='dmx-sender')
+        self._dirty.set()
+        t = threading.Thread(target=self._update_loop)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        with self._lock:
+            if not self._active:
+                return
+            e = self._complete
+            self._active = False
+            self._stopping.set()
+            self._dirty.set()
+        e.wait()
+        self._pool.shutdown(wait=True)
+        self._pool = None
+        self._sending = {}
+
+    def stats(self):
+        return {universe: client.stats() for universe, client in self.universes.items()}
+
+    def _update_loop(self):
+        period = 1.0 / self.frame_rate
+        next_frame = time.monotonic()
+        while True:
+            self._dirty.wait()
+            if not self._active:
+                break
+            self._dirty.clear()
+            now = time.monotonic()
+            next_frame = frame_start(next_frame, period, now)
+            wait = next_frame - now
+            if wait > 0 and self._stopping.wait(wait):
+                break
+            self._send_frames()
+            # Universes count their own dropped frames when a boundary finds them still sending
+            next_frame = next_frame_time(next_frame, period, time.monotonic())[0]
+        self._complete.set()
+
+    def _send_frames(self):
+        now = time.monotonic()
+        for universe, client in self.universes.items():
+            if not client._dirty.is_set():
+                continue
+            sending = self._sending.get(universe)
+            busy = sending is not None and not sending.done()
+            if busy or client._retry_at > now:
+                if busy:
+                    client.frames_dropped += 1
+                # Come back at the next boundary
+                self._dirty.set()
+                continue
+            self._sending[universe] = self._pool.submit(client._send_frame)
+            self._sending[universe].add_done_callback(lambda f, client=client: self._sent(client))
+
+    def _sent(self, client):
+        if client._dirty.is_set():
+            self._dirty.set()